@@ -2,13 +2,28 @@
 """This module implements the AssessmentSnapshot markup specification
 defined by Questionmark."""
 
+import array
+import collections
 import itertools
+import mmap
+import sys
+
+from xml.parsers import expat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import pyslet.xml20081126.structures as xml
 import pyslet.xsdatatypes20041028 as xsi
 import pyslet.qml420 as qml
 
 
+#: the letters used to label the choices in a question
+CHOICE_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
 class Element(xml.Element):
     """Basic element to represent all AML-defined elements"""
     pass
@@ -260,3 +275,576 @@ class Document(xml.Document):
 
 
 xml.MapClassElements(Document.classMap, globals())
+
+
+class AnswerKey(object):
+
+    """A compact index of the questions and choices in a snapshot
+
+    The key records the order of the questions, their IDs and types and
+    the IDs of the choices within each question, but nothing else from
+    the snapshot document.  The data is held in arrays so a key uses a
+    small fraction of the memory of the parsed document and is cheap to
+    cache and to pickle.
+
+    Keys are built one question at a time by calling
+    :meth:`add_question` followed by :meth:`add_choice` for each of its
+    choices, or from a parsed :class:`Document` using
+    :meth:`from_document`.  Iterating over a key yields
+    :class:`KeyQuestion` instances in question order.
+
+    Missing integer IDs are stored as -1 and reported as None."""
+
+    __slots__ = ('qids', 'types', 'qtypes', 'offsets', 'cids', 'cqids')
+
+    def __init__(self):
+        #: an array of question IDs (:attr:`Question.qid`)
+        self.qids = array.array('l')
+        #: a list of the distinct question types (:attr:`Question.type`)
+        self.types = []
+        #: an array of indexes into :attr:`types`, one for each question
+        self.qtypes = array.array('H')
+        #: an array of offsets into :attr:`cids`, one for each question
+        #: plus a final entry marking the end of the last question
+        self.offsets = array.array('l', [0])
+        #: an array of choice IDs (:attr:`Choice.cid`)
+        self.cids = array.array('l')
+        #: a list of choice QML IDs (:attr:`Choice.qid`)
+        self.cqids = []
+
+    @classmethod
+    def from_records(cls, records):
+        """Creates a new key from an iterable of records
+
+        records
+            An iterable of records, such as a :class:`SnapshotReader`.
+            Records other than :class:`QuestionRecord` and
+            :class:`ChoiceRecord` are ignored.
+
+        This method allows a key to be created from a snapshot document
+        without building the document's element tree."""
+        key = cls()
+        for r in records:
+            if isinstance(r, QuestionRecord):
+                key.add_question(r.qid, r.type)
+            elif isinstance(r, ChoiceRecord):
+                key.add_choice(r.cid, r.qid)
+        return key
+
+    @classmethod
+    def from_document(cls, doc):
+        """Creates a new key from a parsed :class:`Document`"""
+        key = cls()
+        for b in doc.root.BlockSnapshot:
+            if b.QuestionList:
+                for q in b.QuestionList.Question:
+                    key.add_question(q.qid, q.type)
+                    if q.Answer:
+                        for c in q.Answer.AnswerThing:
+                            if isinstance(c, Choice):
+                                key.add_choice(c.cid, c.qid)
+        return key
+
+    def add_question(self, qid, qtype):
+        """Adds a question to the end of the key
+
+        qid
+            The integer ID of the question (may be None)
+
+        qtype
+            The question type, e.g., "MC"."""
+        self.qids.append(-1 if qid is None else qid)
+        try:
+            t = self.types.index(qtype)
+        except ValueError:
+            t = len(self.types)
+            self.types.append(qtype)
+        self.qtypes.append(t)
+        self.offsets.append(self.offsets[-1])
+
+    def add_choice(self, cid, qml_id):
+        """Adds a choice to the last question in the key
+
+        cid
+            The integer ID of the choice (may be None)
+
+        qml_id
+            The QML ID of the choice (may be None)."""
+        if not self.qids:
+            raise ValueError("AnswerKey: choice added before question")
+        self.cids.append(-1 if cid is None else cid)
+        self.cqids.append(qml_id)
+        self.offsets[-1] += 1
+
+    def nchoices(self, i):
+        """Returns the number of choices in the question at index i"""
+        return self.offsets[i + 1] - self.offsets[i]
+
+    def __len__(self):
+        return len(self.qids)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.qids)
+        if i < 0 or i >= len(self.qids):
+            raise IndexError("AnswerKey index out of range")
+        return KeyQuestion(self, i)
+
+    def __iter__(self):
+        for i in xrange(len(self.qids)):
+            yield KeyQuestion(self, i)
+
+    def to_json_object(self):
+        """Returns a dictionary suitable for serialising as JSON
+
+        The key can be recreated with :meth:`from_json_object`."""
+        return {'qids': self.qids.tolist(), 'types': list(self.types),
+                'qtypes': self.qtypes.tolist(),
+                'offsets': self.offsets.tolist(),
+                'cids': self.cids.tolist(), 'cqids': list(self.cqids)}
+
+    @classmethod
+    def from_json_object(cls, obj):
+        """Creates a new key from the result of :meth:`to_json_object`"""
+        key = cls()
+        key.qids = array.array('l', obj['qids'])
+        key.types = list(obj['types'])
+        key.qtypes = array.array('H', obj['qtypes'])
+        key.offsets = array.array('l', obj['offsets'])
+        key.cids = array.array('l', obj['cids'])
+        key.cqids = list(obj['cqids'])
+        return key
+
+    def __getstate__(self):
+        return (self.qids, self.types, self.qtypes, self.offsets, self.cids,
+                self.cqids)
+
+    def __setstate__(self, state):
+        (self.qids, self.types, self.qtypes, self.offsets, self.cids,
+         self.cqids) = state
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self)
+        for a in (self.qids, self.qtypes, self.offsets, self.cids):
+            size += sys.getsizeof(a)
+        for l in (self.types, self.cqids):
+            size += sys.getsizeof(l)
+            for item in l:
+                if item is not None:
+                    size += sys.getsizeof(item)
+        return size
+
+
+class KeyQuestion(object):
+
+    """A view of a single question in an :class:`AnswerKey`
+
+    key
+        The AnswerKey
+
+    i
+        The index of the question in the key
+
+    Views are created on demand when iterating an AnswerKey, they hold
+    no data of their own."""
+
+    __slots__ = ('key', 'index')
+
+    def __init__(self, key, i):
+        self.key = key
+        #: the 0-based index of the question
+        self.index = i
+
+    @property
+    def number(self):
+        """The 1-based position of the question in the assessment"""
+        return self.index + 1
+
+    @property
+    def qid(self):
+        """The ID of the question"""
+        qid = self.key.qids[self.index]
+        return None if qid < 0 else qid
+
+    @property
+    def type(self):
+        """The question type, e.g., MC or ESSAY"""
+        key = self.key
+        return key.types[key.qtypes[self.index]]
+
+    @property
+    def nchoices(self):
+        """The number of choices in the question"""
+        return self.key.nchoices(self.index)
+
+    @property
+    def choice_ids(self):
+        """A list of the IDs of the choices in the question"""
+        key = self.key
+        return [None if cid < 0 else cid for cid in
+                key.cids[key.offsets[self.index]:key.offsets[self.index + 1]]]
+
+    @property
+    def choice_qids(self):
+        """A list of the QML IDs of the choices in the question"""
+        key = self.key
+        return key.cqids[key.offsets[self.index]:key.offsets[self.index + 1]]
+
+    @property
+    def letters(self):
+        """A string of letters, one to label each choice"""
+        return CHOICE_LETTERS[:self.nchoices]
+
+
+#: the question types in which at most one choice may be selected
+SINGLE_RESPONSE_TYPES = ('MC', 'TF', 'YN', 'LKS')
+
+
+class SheetDecoder(object):
+
+    """Decodes the responses on scanned answer sheets
+
+    key
+        The :class:`AnswerKey` of the snapshot printed on the sheets
+
+    The responses to each question are strings containing the letters
+    of the selected choices, see :meth:`decode`.  If numpy is installed
+    all the sheets in a batch are decoded together with array
+    operations, otherwise they are decoded one response at a time.
+    Both methods give the same results."""
+
+    def __init__(self, key):
+        self.key = key
+        #: the number of questions
+        self.nquestions = len(key)
+        #: the number of choices that can be selected in each question
+        self.nchoices = [min(key.nchoices(i), len(CHOICE_LETTERS))
+                         for i in xrange(self.nquestions)]
+        #: the maximum number of choices in any question
+        self.max_choices = max(self.nchoices) if self.nchoices else 0
+        #: True for questions in which only one choice may be selected
+        self.single = [key.types[t] in SINGLE_RESPONSE_TYPES for
+                       t in key.qtypes]
+        # the ChoiceOrderNumber values of the choices
+        self._order = [unicode(i + 1) for i in xrange(self.max_choices)]
+
+    def decode(self, responses):
+        """Decodes a batch of answer sheets
+
+        responses
+            A list with one item per sheet, each item is a list of
+            strings containing the letters of the choices selected in
+            each question in question order.  Letters must be upper
+            case, other characters are ignored.  Missing responses are
+            treated as blank, extra responses are ignored.
+
+        Returns a :class:`DecodedSheets` instance."""
+        if numpy is not None:
+            result = self._decode_arrays(responses)
+            if result is not None:
+                return result
+        return self._decode_lists(responses)
+
+    def _decode_arrays(self, responses):
+        nq = self.nquestions
+        nchoices = len(CHOICE_LETTERS)
+        cells = []
+        for r in responses:
+            cells.extend(r[:nq])
+            if len(r) < nq:
+                cells.extend([''] * (nq - len(r)))
+        if not cells:
+            return None
+        # join all the responses with NUL separators and then find the
+        # letters and the response each one belongs to in one pass
+        try:
+            data = '\x00'.join(cells)
+        except UnicodeDecodeError:
+            data = None
+        if data is None or isinstance(data, unicode):
+            # UTF-8 multi-byte sequences never contain letters
+            data = '\x00'.join(
+                c.encode('utf-8') if isinstance(c, unicode) else c
+                for c in cells)
+        data = numpy.frombuffer(data, dtype=numpy.uint8)
+        separators = data == 0
+        if int(separators.sum()) != max(len(cells) - 1, 0):
+            # a response contains NUL, fall back to the slow way
+            return None
+        cell = numpy.cumsum(separators)
+        letters = (data >= ord('A')) & (data <= ord('Z'))
+        marks = numpy.zeros((len(cells), nchoices), dtype=bool)
+        marks[cell[letters], data[letters] - ord('A')] = True
+        marks = marks.reshape((len(responses), nq, nchoices))
+        allowed = (numpy.arange(nchoices)[numpy.newaxis, :] <
+                   numpy.array(self.nchoices, dtype=int).reshape((nq, 1)))
+        selected = marks[:, :, :self.max_choices] & \
+            allowed[:, :self.max_choices]
+        invalid = (marks & ~allowed).any(axis=2)
+        count = selected.sum(axis=2)
+        blank = (count == 0) & (numpy.array(self.nchoices) > 0)
+        multiple = (count > 1) & numpy.array(self.single, dtype=bool)
+        return DecodedSheets(self, selected, blank, multiple, invalid)
+
+    def _decode_lists(self, responses):
+        nq = self.nquestions
+        selected = []
+        blank = []
+        multiple = []
+        invalid = []
+        for r in responses:
+            sheet_selected = []
+            sheet_blank = []
+            sheet_multiple = []
+            sheet_invalid = []
+            for i in xrange(nq):
+                response = r[i] if i < len(r) else ''
+                letters = CHOICE_LETTERS[:self.nchoices[i]]
+                choices = [c in response for c in letters]
+                count = choices.count(True)
+                choices += [False] * (self.max_choices - len(choices))
+                sheet_selected.append(choices)
+                sheet_blank.append(count == 0 and self.nchoices[i] > 0)
+                sheet_multiple.append(count > 1 and self.single[i])
+                sheet_invalid.append(
+                    any(c in response for c in
+                        CHOICE_LETTERS[self.nchoices[i]:]))
+            selected.append(sheet_selected)
+            blank.append(sheet_blank)
+            multiple.append(sheet_multiple)
+            invalid.append(sheet_invalid)
+        return DecodedSheets(self, selected, blank, multiple, invalid)
+
+
+class DecodedSheets(object):
+
+    """The result of decoding a batch of answer sheets
+
+    Created by :meth:`SheetDecoder.decode`.  The results are indexed by
+    sheet, question and choice in that order.  They are numpy arrays
+    if numpy is installed, otherwise nested lists."""
+
+    def __init__(self, decoder, selected, blank, multiple, invalid):
+        self.decoder = decoder
+        #: True if a choice was selected, the choices of each question
+        #: are padded to :attr:`SheetDecoder.max_choices` with False
+        self.selected = selected
+        #: True if no choice was selected in a question
+        self.blank = blank
+        #: True if more than one choice was selected in a question that
+        #: only allows one
+        self.multiple = multiple
+        #: True if a response contained the letter of a choice that the
+        #: question does not have
+        self.invalid = invalid
+
+    def __len__(self):
+        return len(self.selected)
+
+    def answer_upload(self, i):
+        """Returns the answer upload for sheet *i*
+
+        The result is a dictionary suitable for serialising as JSON, the
+        AttemptID must be added by the caller."""
+        selected = self.selected[i]
+        if numpy is not None and isinstance(selected, numpy.ndarray):
+            selected = selected.tolist()
+        order = self.decoder._order
+        qlist = []
+        for q, (n, choices) in enumerate(
+                zip(self.decoder.nchoices, selected)):
+            qlist.append({
+                "QuestionOrderNumber": q + 1,
+                "UploadedChoices": [
+                    {"ChoiceOrderNumber": order[c], "Selected": choices[c]}
+                    for c in xrange(n)]})
+        return {"QuestionAndChoices": qlist}
+
+    #: the problems reported by :meth:`diagnostics`
+    PROBLEMS = ('blank', 'multiple', 'invalid')
+
+    def diagnostics(self):
+        """Returns a list of the problems found on the sheets
+
+        Each item is a tuple of (sheet index, question number, problem)
+        where problem is one of the strings in :attr:`PROBLEMS`.  The
+        list is sorted by sheet and question."""
+        if numpy is not None and isinstance(self.blank, numpy.ndarray):
+            # nonzero returns the indices in sheet, question order
+            i, q, p = numpy.nonzero(numpy.dstack(
+                [getattr(self, problem) for problem in self.PROBLEMS]))
+            return zip(i.tolist(), (q + 1).tolist(),
+                       [self.PROBLEMS[k] for k in p.tolist()])
+        result = []
+        for i, sheet in enumerate(zip(
+                *[getattr(self, problem) for problem in self.PROBLEMS])):
+            for q, flags in enumerate(zip(*sheet)):
+                for problem, flag in zip(self.PROBLEMS, flags):
+                    if flag:
+                        result.append((i, q + 1, problem))
+        return result
+
+
+#: A record of a BlockSnapshot yielded by :class:`SnapshotReader`.
+#: The values are taken from the BlockSnapshotId, BlockId, BlockName
+#: and BlockNumber elements, integer values are None if missing.
+BlockRecord = collections.namedtuple(
+    'BlockRecord', ['block_snapshot_id', 'block_id', 'name', 'number'])
+
+#: A record of a QUESTION yielded by :class:`SnapshotReader`.  The
+#: values correspond to the attributes of :class:`Question`.
+QuestionRecord = collections.namedtuple(
+    'QuestionRecord', ['qid', 'type', 'description', 'block'])
+
+#: A record of a CHOICE yielded by :class:`SnapshotReader`.  The values
+#: correspond to the attributes of :class:`Choice`.
+ChoiceRecord = collections.namedtuple('ChoiceRecord', ['cid', 'qid'])
+
+
+class SnapshotReader(object):
+
+    """Reads an AssessmentSnapshot document incrementally
+
+    src
+        A file-like object, a memory mapped file (mmap) or an iterable
+        of strings, for example, the data generator returned by an OData
+        media resource collection's read_stream_close method.  A memory
+        mapped file is parsed in place without copying the data.
+
+    chunk_size (64K)
+        The size of the reads made from a file-like or memory mapped
+        src.
+
+    Unlike :class:`Document` the reader does not build a tree of
+    elements.  Iterating over the reader yields :class:`BlockRecord`,
+    :class:`QuestionRecord` and :class:`ChoiceRecord` instances in
+    document order as soon as the data needed to create them has been
+    parsed.  A BlockRecord precedes the records of the questions in the
+    block and each QuestionRecord is followed by the records of its
+    choices.
+
+    The content and outcomes of questions and everything else not
+    required to create these records are skipped, the memory used is
+    therefore bounded by the size of the chunks read from src and not
+    by the size of the document.
+
+    A reader can only be iterated once.  Badly formed documents raise
+    :class:`xml.parsers.expat.ExpatError`."""
+
+    #: the elements we descend into, keyed on the parent element
+    CHILDREN = {
+        None: ('AssessmentSnapshot', ),
+        'AssessmentSnapshot': ('BlockSnapshot', ),
+        'BlockSnapshot': ('BlockSnapshotId', 'BlockId', 'BlockName',
+                          'BlockNumber', 'questionList'),
+        'questionList': ('QUESTION', ),
+        'QUESTION': ('ANSWER', ),
+        'ANSWER': ('CHOICE', )}
+
+    #: the elements whose text content is collected
+    TEXT_ELEMENTS = ('BlockSnapshotId', 'BlockId', 'BlockName', 'BlockNumber')
+
+    def __init__(self, src, chunk_size=0x10000):
+        self.src = src
+        self.chunk_size = chunk_size
+        self._records = []
+        self._stack = []
+        self._skip = 0
+        self._block = None
+        self._text = None
+
+    def __iter__(self):
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._character_data
+        for data in self._read_chunks():
+            parser.Parse(data, False)
+            if self._records:
+                records, self._records = self._records, []
+                for r in records:
+                    yield r
+        parser.Parse(b'', True)
+        for r in self._records:
+            yield r
+        self._records = []
+
+    def _read_chunks(self):
+        if isinstance(self.src, mmap.mmap):
+            for pos in xrange(0, len(self.src), self.chunk_size):
+                yield buffer(self.src, pos, self.chunk_size)
+        elif hasattr(self.src, 'read'):
+            while True:
+                data = self.src.read(self.chunk_size)
+                if not data:
+                    break
+                yield data
+        else:
+            for data in self.src:
+                if data:
+                    yield data
+
+    def _start_element(self, name, attrs):
+        if self._skip:
+            self._skip += 1
+            return
+        parent = self._stack[-1] if self._stack else None
+        if name not in self.CHILDREN.get(parent, ()):
+            # skip this element and all of its content
+            self._skip = 1
+            return
+        self._stack.append(name)
+        if name == 'BlockSnapshot':
+            self._block = {}
+        elif name in self.TEXT_ELEMENTS:
+            self._text = []
+        elif name == 'questionList':
+            self._add_block()
+        elif name == 'QUESTION':
+            self._records.append(QuestionRecord(
+                qid=_decode_integer(attrs.get('ID')),
+                type=attrs.get('Type'),
+                description=attrs.get('Description'),
+                block=_decode_integer(attrs.get('Block'))))
+        elif name == 'CHOICE':
+            self._records.append(ChoiceRecord(
+                cid=_decode_integer(attrs.get('ID')),
+                qid=attrs.get('QML_ID')))
+
+    def _end_element(self, name):
+        if self._skip:
+            self._skip -= 1
+            return
+        self._stack.pop()
+        if self._text is not None:
+            self._block[name] = u''.join(self._text).strip()
+            self._text = None
+        elif name == 'BlockSnapshot':
+            # a block without a questionList
+            self._add_block()
+
+    def _character_data(self, data):
+        if self._text is not None and not self._skip:
+            self._text.append(data)
+
+    def _add_block(self):
+        if self._block is not None:
+            self._records.append(BlockRecord(
+                block_snapshot_id=_decode_integer(
+                    self._block.get('BlockSnapshotId')),
+                block_id=_decode_integer(self._block.get('BlockId')),
+                name=self._block.get('BlockName'),
+                number=_decode_integer(self._block.get('BlockNumber'))))
+            self._block = None
+
+
+def _decode_integer(src):
+    # lenient integer decoding for the reader, returns None if src is
+    # missing or invalid
+    if not src:
+        return None
+    try:
+        return xsi.DecodeInteger(src.strip())
+    except ValueError:
+        return None
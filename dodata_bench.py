@@ -0,0 +1,601 @@
+#! /usr/bin/env python
+"""Benchmarks the demo app against a local Delivery OData service
+
+The Questionmark OnDemand services can't be used for load testing so
+this script starts a stand-in: an in-memory OData service with the
+parts of the Delivery OData model used by the app, described by
+dodata_bench.xml, filled with synthetic Assessments, Groups,
+Participants, PrintBatches and AssessmentSnapshot data.  The size of
+the data set and the latency added to every call to the service are
+set with command line options.
+
+By default the app is created in the same process and its routes are
+called directly with concurrent threads.  The options of dodata_demo.py
+may be given to configure the app, except --async as gevent can't be
+used in-process.  Alternatively, start the service
+alone with --mock-only, run dodata_demo.py (with any number of workers)
+using the printed URL as its --deliveryodata option and benchmark it
+over HTTP with --url, giving the same data set options in both runs.
+
+For each route the number of requests, errors, throughput and latency
+percentiles are reported.  Use --output to save the results as JSON so
+that runs can be compared."""
+
+import httplib
+import itertools
+import json
+import logging
+import os.path
+import random
+import SocketServer
+import StringIO
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+from optparse import OptionParser
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+
+import pyslet.http.params as params
+import pyslet.iso8601 as iso
+import pyslet.odata2.core as odata
+import pyslet.odata2.memds as memds
+import pyslet.odata2.metadata as edmx
+import pyslet.odata2.server as server
+
+from dodata_demo import DemoApp
+
+
+#: the CSDL document describing the service
+METADATA = os.path.join(os.path.split(os.path.abspath(__file__))[0],
+                        'dodata_bench.xml')
+
+
+def make_snapshot_data(sid, nquestions, nblocks=2, nchoices=4):
+    """Returns a synthetic AssessmentSnapshot document
+
+    sid
+        The ID of the snapshot, used to make the question IDs unique
+
+    nquestions
+        The number of questions, these are divided between nblocks
+        blocks.  Every fifth question is an essay, the others are
+        multiple choice questions with nchoices choices.
+
+    The result is a UTF-8 encoded string."""
+    data = ['<?xml version="1.0" encoding="utf-8"?>',
+            '<AssessmentSnapshot><AssessmentId>%i</AssessmentId>'
+            '<Header/>' % sid]
+    qnum = 0
+    for b in range(1, nblocks + 1):
+        data.append(
+            '<BlockSnapshot><BlockSnapshotId>%i</BlockSnapshotId>'
+            '<BlockType>Q</BlockType><BlockId>%i</BlockId>'
+            '<BlockName>Block %i</BlockName>'
+            '<BlockNumber>%i</BlockNumber>'
+            '<ShowFeedBack>false</ShowFeedBack>'
+            '<ShuffleQuestions>false</ShuffleQuestions>'
+            '<introductionText>Block %i</introductionText>'
+            '<questionList>' % (b, b, b, b, b))
+        bquestions = nquestions // nblocks
+        if b == nblocks:
+            bquestions += nquestions % nblocks
+        for i in range(bquestions):
+            qnum += 1
+            qid = sid * 100000 + qnum
+            qtype = "ESSAY" if qnum % 5 == 0 else "MC"
+            data.append(
+                '<QUESTION ID="%i" Type="%s" Description="Question %i">'
+                '<CONTENT TYPE="text/html">&lt;p&gt;What is the answer to '
+                'question %i?&lt;/p&gt;</CONTENT>'
+                '<OUTCOME ID="0" SCORE="1"><CONDITION>0</CONDITION>'
+                '</OUTCOME><ANSWER QTYPE="%s">' %
+                (qid, qtype, qnum, qnum, qtype))
+            for c in range(nchoices if qtype == "MC" else 1):
+                data.append(
+                    '<CHOICE ID="%i" QML_ID="%i_%i">'
+                    '<CONTENT TYPE="text/plain">Choice %i</CONTENT>'
+                    '</CHOICE>' % (c, qid, c, c))
+            data.append('</ANSWER></QUESTION>')
+        data.append('</questionList></BlockSnapshot>')
+    data.append('</AssessmentSnapshot>')
+    return '\n'.join(data)
+
+
+class MockCollection(memds.EntityCollection):
+
+    """Inserts entities the way the Delivery OData service does
+
+    Entities inserted with an ID of 0 are given the next free ID.  New
+    PrintBatches are linked to the AssessmentSnapshot and Group given
+    by their SnapshotID and GroupID properties."""
+
+    def insert_entity(self, entity, from_end=None):
+        with self.entity_store.container.lock:
+            if entity['ID'].value == 0:
+                keys = list(self.keys())
+                entity['ID'].set_from_value(max(keys) + 1 if keys else 1)
+            super(MockCollection, self).insert_entity(entity, from_end)
+        if self.entity_set.name == 'PrintBatches':
+            container = self.entity_set.parent
+            with container['AssessmentSnapshots'].OpenCollection() as \
+                    snapshots:
+                s = snapshots[entity['SnapshotID'].value]
+            with container['Groups'].OpenCollection() as groups:
+                g = groups[entity['GroupID'].value]
+            with entity['AssessmentSnapshot'].OpenCollection() as nav:
+                nav.replace(s)
+            with entity['Group'].OpenCollection() as nav:
+                nav.replace(g)
+
+
+class MockServer(SocketServer.ThreadingMixIn, WSGIServer):
+
+    """Serves each request in its own thread"""
+
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    """Does not log requests"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockDeliveryService(object):
+
+    """A local stand-in for the Delivery OData service
+
+    port (8089)
+        The port to listen on
+
+    assessments (5)
+        The number of Assessments
+
+    snapshots (2)
+        The number of AssessmentSnapshots of each Assessment
+
+    questions (20)
+        The number of questions in each snapshot
+
+    groups (5)
+        The number of Groups
+
+    participants (20)
+        The number of Participants in each Group
+
+    batches (10)
+        The number of PrintBatches, these use the snapshots and groups
+        in turn
+
+    latency (0.0)
+        The time in seconds added to every call
+
+    jitter (0.0)
+        The maximum random time added to latency
+
+    The IDs of the entities in each entity set are numbered from 1.
+    The snapshots of Assessment a are numbered from (a - 1) * snapshots
+    + 1 and the Participants in Group g from (g - 1) * participants + 1.
+    Calls may add Attempts, AnswerUploads and further PrintBatches."""
+
+    def __init__(self, port=8089, assessments=5, snapshots=2, questions=20,
+                 groups=5, participants=20, batches=10, latency=0.0,
+                 jitter=0.0):
+        self.port = port
+        self.assessments = assessments
+        self.snapshots = snapshots
+        self.questions = questions
+        self.groups = groups
+        self.participants = participants
+        self.batches = batches
+        self.latency = latency
+        self.jitter = jitter
+        #: the URL of the service root
+        self.url = 'http://localhost:%i/' % port
+        doc = edmx.Document()
+        with open(METADATA, 'rb') as f:
+            doc.Read(src=f)
+        self.container = doc.root.DataServices['QM.DeliveryOData']
+        store = memds.InMemoryEntityContainer(self.container)
+        for name in ('PrintBatches', 'Attempts', 'AssessmentSnapshots'):
+            self.container[name].bind(
+                MockCollection, entity_store=store.entityStorage[name])
+        self.odata = server.Server(serviceRoot=self.url)
+        self.odata.SetModel(doc)
+        self.populate()
+        self.server = None
+
+    def populate(self):
+        """Adds the synthetic entities"""
+        now = iso.TimePoint.from_now()
+        c = self.container
+        with c['Assessments'].OpenCollection() as collection:
+            for aid in range(1, self.assessments + 1):
+                a = collection.new_entity()
+                a['ID'].set_from_value(aid)
+                a['Name'].set_from_value(u"Assessment %i" % aid)
+                a['Language'].set_from_value(u"en")
+                a['ModifiedDateTime'].set_from_value(now)
+                collection.insert_entity(a)
+        nsnapshots = self.assessments * self.snapshots
+        with c['AssessmentSnapshots'].OpenCollection() as collection:
+            for sid in range(1, nsnapshots + 1):
+                s = collection.new_entity()
+                s['ID'].set_from_value(sid)
+                s['AssessmentID'].set_from_value(
+                    (sid - 1) // self.snapshots + 1)
+                s['Name'].set_from_value(u"Snapshot %i" % sid)
+                s['Language'].set_from_value(u"en")
+                s['CreatedDateTime'].set_from_value(now)
+                s['ModifiedDateTime'].set_from_value(now)
+                collection.insert_entity(s)
+        with c['AssessmentSnapshotsData'].OpenCollection() as collection:
+            for sid in range(1, nsnapshots + 1):
+                data = make_snapshot_data(sid, self.questions)
+                sinfo = odata.StreamInfo(
+                    type=params.MediaType.from_str('text/xml'),
+                    size=len(data))
+                collection.new_stream(StringIO.StringIO(data), sinfo=sinfo,
+                                      key=sid)
+        with c['Participants'].OpenCollection() as collection:
+            for pid in range(1, self.groups * self.participants + 1):
+                p = collection.new_entity()
+                p['ID'].set_from_value(pid)
+                p['Name'].set_from_value(u"participant%i" % pid)
+                p['FirstName'].set_from_value(u"First%i" % pid)
+                p['LastName'].set_from_value(u"Last%i" % pid)
+                p['ModifiedDateTime'].set_from_value(now)
+                collection.insert_entity(p)
+        with c['Groups'].OpenCollection() as collection:
+            for gid in range(1, self.groups + 1):
+                g = collection.new_entity()
+                g['ID'].set_from_value(gid)
+                g['Name'].set_from_value(u"Group %i" % gid)
+                g['ModifiedDateTime'].set_from_value(now)
+                collection.insert_entity(g)
+                first = (gid - 1) * self.participants + 1
+                with g['Participants'].OpenCollection() as members:
+                    with c['Participants'].OpenCollection() as everyone:
+                        for pid in range(first, first + self.participants):
+                            members[pid] = everyone[pid]
+        with c['PrintBatches'].OpenCollection() as collection:
+            for bid in range(1, self.batches + 1):
+                b = collection.new_entity()
+                b['ID'].set_from_value(bid)
+                b['Name'].set_from_value(u"Batch %i" % bid)
+                b['SnapshotID'].set_from_value(self.get_batch_snapshot(bid))
+                b['GroupID'].set_from_value(self.get_batch_group(bid))
+                b['CreatedDateTime'].set_from_value(now)
+                b['ModifiedDateTime'].set_from_value(now)
+                collection.insert_entity(b)
+
+    def get_batch_snapshot(self, bid):
+        """Returns the ID of the snapshot used by PrintBatch *bid*"""
+        return (bid - 1) % (self.assessments * self.snapshots) + 1
+
+    def get_batch_group(self, bid):
+        """Returns the ID of the group used by PrintBatch *bid*"""
+        return (bid - 1) % self.groups + 1
+
+    def __call__(self, environ, start_response):
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        def str_response(status, headers, exc_info=None):
+            # the pyslet server may use unicode header values
+            return start_response(
+                status, [(k, str(v)) for k, v in headers], exc_info)
+        return self.odata(environ, str_response)
+
+    def start(self):
+        """Starts serving in a background thread"""
+        self.server = make_server('localhost', self.port, self,
+                                  server_class=MockServer,
+                                  handler_class=QuietRequestHandler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+    def stop(self):
+        """Stops serving if started"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class Benchmark(object):
+
+    """Drives the routes of the demo app
+
+    service
+        The :class:`MockDeliveryService` used by the app, the
+        parameters of each request are chosen from its data
+
+    app (None)
+        A WSGI callable, the app is called directly in the calling
+        process
+
+    url (None)
+        The URL of an app that is already running, used if no app is
+        given
+
+    threads (4)
+        The number of requests made at once
+
+    Each request to a route uses different entities, cycling through
+    the data in the service."""
+
+    #: the routes that can be benchmarked
+    ROUTES = ('home', 'pasprint3', 'pasupload4', 'pasupload5',
+              'snapviewscan', 'pasprintbatch')
+
+    def __init__(self, service, app=None, url=None, threads=4):
+        self.service = service
+        self.app = app
+        if url is not None:
+            url = urlparse.urlsplit(url)
+            self.host = url.netloc
+            self.path = url.path.rstrip('/')
+        self.threads = threads
+        self.local = threading.local()
+
+    def get_request(self, route, i):
+        """Returns the *i*th request to *route*
+
+        The result is a tuple of method, path, query string and form
+        data (None for GET requests)."""
+        service = self.service
+        if route == 'home':
+            return 'GET', '/', '', None
+        elif route == 'pasprint3':
+            gid = i % service.groups + 1
+            aid = i % service.assessments + 1
+            return 'POST', '/pasprint3', '', {'gid': gid, 'aid': aid}
+        elif route in ('pasupload4', 'pasupload5'):
+            bid = i % service.batches + 1
+            first = (service.get_batch_group(bid) - 1) * service.participants
+            pid = first + (i // service.batches) % service.participants + 1
+            form = {'bid': bid, 'pid': pid}
+            if route == 'pasupload5':
+                for q in range(1, service.questions + 1):
+                    form['q%i' % q] = "ABCD"[(i + q) % 4]
+            return 'POST', '/' + route, '', form
+        elif route == 'snapviewscan':
+            sid = i % (service.assessments * service.snapshots) + 1
+            return 'GET', '/snapviewscan', 'sid=%i' % sid, None
+        elif route == 'pasprintbatch':
+            bid = i % service.batches + 1
+            return 'GET', '/pasprintbatch', 'bid=%i' % bid, None
+        else:
+            raise ValueError("Unknown route: %s" % route)
+
+    def call(self, method, path, query, form):
+        """Makes a request, returns the response status"""
+        body = '' if form is None else urllib.urlencode(form)
+        if self.app is not None:
+            return self.call_app(method, path, query, body)
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = httplib.HTTPConnection(self.host)
+            self.local.connection = connection
+        if query:
+            path = path + '?' + query
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        try:
+            connection.request(method, self.path + path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (httplib.HTTPException, IOError):
+            connection.close()
+            self.local.connection = None
+            raise
+
+    def call_app(self, method, path, query, body):
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO.StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False}
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status.append(status_line)
+        for data in self.app(environ, start_response):
+            pass
+        return int(status[-1].split()[0])
+
+    def run(self, route, requests):
+        """Makes *requests* requests to *route*
+
+        Returns a dictionary with the number of requests, the number of
+        errors (requests that raised an exception or returned a 4xx or
+        5xx status), the elapsed time, the throughput in requests per
+        second and the 50th, 90th and 99th percentile and maximum
+        latencies in seconds."""
+        counter = itertools.count()
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    i = next(counter)
+                if i >= requests:
+                    break
+                start = time.time()
+                try:
+                    status = self.call(*self.get_request(route, i))
+                    failed = status >= 400
+                except Exception as err:
+                    logging.error("%s request %i: %s", route, i, str(err))
+                    failed = True
+                latency = time.time() - start
+                with lock:
+                    latencies.append(latency)
+                    if failed:
+                        errors.append(i)
+        start = time.time()
+        workers = [threading.Thread(target=worker)
+                   for t in range(self.threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.time() - start
+        latencies.sort()
+        return {
+            'route': route,
+            'requests': requests,
+            'errors': len(errors),
+            'elapsed': elapsed,
+            'throughput': requests / elapsed if elapsed else 0.0,
+            'p50': self.percentile(latencies, 50),
+            'p90': self.percentile(latencies, 90),
+            'p99': self.percentile(latencies, 99),
+            'max': latencies[-1] if latencies else 0.0}
+
+    @staticmethod
+    def percentile(values, p):
+        """Returns the *p*th percentile of a sorted list of values"""
+        if not values:
+            return 0.0
+        i = int(round(p * (len(values) - 1) / 100.0))
+        return values[i]
+
+
+def add_options(parser):
+    """Adds the benchmark options to *parser*"""
+    parser.add_option("--mock-port", dest="mock_port", type="int",
+                      default=8089,
+                      help="port of the local Delivery OData service")
+    parser.add_option("--assessments", dest="assessments", type="int",
+                      default=5, help="number of assessments")
+    parser.add_option("--snapshots", dest="snapshots", type="int",
+                      default=2, help="number of snapshots per assessment")
+    parser.add_option("--questions", dest="questions", type="int",
+                      default=20, help="number of questions per snapshot")
+    parser.add_option("--groups", dest="groups", type="int", default=5,
+                      help="number of groups")
+    parser.add_option("--participants", dest="participants", type="int",
+                      default=20, help="number of participants per group")
+    parser.add_option("--batches", dest="batches", type="int", default=10,
+                      help="number of print batches")
+    parser.add_option("--latency", dest="latency", type="float",
+                      default=0.0,
+                      help="seconds added to each call to the service")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0.0,
+                      help="maximum random seconds added to latency")
+    parser.add_option("-n", "--requests", dest="requests", type="int",
+                      default=100, help="number of requests per route")
+    parser.add_option("-t", "--threads", dest="threads", type="int",
+                      default=4, help="number of concurrent requests")
+    parser.add_option("--warmup", dest="warmup", type="int", default=10,
+                      help="untimed requests made to each route first")
+    parser.add_option("--url", dest="url", default=None,
+                      help="benchmark the app running at this URL")
+    parser.add_option("--mock-only", dest="mock_only", action="store_true",
+                      default=False,
+                      help="run the local service until interrupted")
+    parser.add_option("--output", dest="output", default=None,
+                      help="save the results as JSON in this file")
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] [route ...]")
+    DemoApp.add_options(parser)
+    add_options(parser)
+    (options, args) = parser.parse_args()
+    routes = args or Benchmark.ROUTES
+    for route in routes:
+        if route not in Benchmark.ROUTES:
+            parser.error("Unknown route %s, expected one of: %s" %
+                         (route, ", ".join(Benchmark.ROUTES)))
+    if options.async_connections and not options.url:
+        parser.error("--async can't be used in-process, run dodata_demo.py "
+                     "with --async and benchmark it with --url instead")
+    service = MockDeliveryService(
+        options.mock_port, assessments=options.assessments,
+        snapshots=options.snapshots, questions=options.questions,
+        groups=options.groups, participants=options.participants,
+        batches=options.batches, latency=options.latency,
+        jitter=options.jitter)
+    if not options.url:
+        service.start()
+    if options.mock_only:
+        print("Serving Delivery OData at %s" % service.url)
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    if options.url:
+        # the service options must match those of the --mock-only
+        # process used by the app
+        benchmark = Benchmark(service, url=options.url,
+                              threads=options.threads)
+    else:
+        if not (options.customer_id or options.deliveryodata_url):
+            options.deliveryodata_url = service.url
+        if options.user is None:
+            options.user = 'bench'
+        if options.password is None:
+            options.password = 'bench'
+        # also overrides the settings file: gevent's monkey patch would
+        # deadlock the app with the service's server thread
+        options.async_connections = 0
+        DemoApp.settings_file = os.path.join(
+            os.path.split(os.path.abspath(__file__))[0], 'settings.json')
+        DemoApp.setup(options, args)
+        benchmark = Benchmark(service, app=DemoApp().call_wrapper,
+                              threads=options.threads)
+    results = []
+    print("%-14s %8s %6s %8s %8s %8s %8s %8s" % (
+        "route", "requests", "errors", "req/s", "p50 ms", "p90 ms",
+        "p99 ms", "max ms"))
+    for route in routes:
+        if options.warmup:
+            benchmark.run(route, options.warmup)
+        result = benchmark.run(route, options.requests)
+        results.append(result)
+        print("%-14s %8i %6i %8.1f %8.1f %8.1f %8.1f %8.1f" % (
+            route, result['requests'], result['errors'],
+            result['throughput'], result['p50'] * 1000,
+            result['p90'] * 1000, result['p99'] * 1000,
+            result['max'] * 1000))
+    if options.output:
+        with open(options.output, 'wb') as f:
+            json.dump({'options': {
+                'assessments': options.assessments,
+                'snapshots': options.snapshots,
+                'questions': options.questions,
+                'groups': options.groups,
+                'participants': options.participants,
+                'batches': options.batches,
+                'latency': options.latency,
+                'jitter': options.jitter,
+                'threads': options.threads,
+                'url': options.url}, 'results': results}, f, indent=2)
+    service.stop()
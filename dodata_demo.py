@@ -1,36 +1,2462 @@
 #! /usr/bin/env python
 
+import bisect
+import collections
+import csv
+import errno
 import getpass
+import hashlib
+import io
 import json
 import logging
+import mmap
+import multiprocessing
 import os.path
+import Queue
+import signal
 import ssl
 import string
 import StringIO
+import struct
 import sys
+import tempfile
+import threading
 import time
+import urllib
+import zlib
 
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
+from wsgiref.simple_server import make_server
+
+try:
+    import gevent
+    import gevent.monkey
+    import gevent.pool
+    import gevent.pywsgi
+except ImportError:
+    gevent = None
 
 import pyslet.http.auth as auth
 import pyslet.http.client as http
+import pyslet.http.messages as messages
 import pyslet.http.params as params
 import pyslet.iso8601 as iso
 import pyslet.odata2.client as client
 import pyslet.odata2.core as odata
+import pyslet.odata2.metadata as edmx
+import pyslet.rfc5023 as atompub
 import pyslet.wsgi as wsgi
 import pyslet.xml20081126.structures as xml
 
-from pyslet.rfc2396 import URI
-from pyslet.wsgi_django import DjangoApp
+from django.conf import settings as django_settings
+from django.template import Context
+from django.template.loader import get_template
+from pyslet.rfc2396 import FileURL, URI
+from pyslet.wsgi_django import DjangoApp
+
+import aml
+
+
+US_ONDEMAND = "https://ondemand.questionmark.com/deliveryodata/%s"
+EU_ONDEMAND = "https://ondemand.questionmark.eu/deliveryodata/%s"
+
+
+class SnapshotCache(object):
+
+    """A cache of parsed AssessmentSnapshots
+
+    max_entries (64)
+        The maximum number of snapshots to keep in the cache
+
+    max_size (64MB)
+        The approximate maximum number of bytes of snapshot data to
+        keep in the cache.  The size of each entry is estimated by the
+        caller.
+
+    Snapshots are cached against their ID along with the
+    ModifiedDateTime of the AssessmentSnapshot entity they were read
+    from.  A lookup with a different modification time discards the
+    cached entry.  When either limit is exceeded the least recently used
+    entries are evicted.  Instances are thread safe."""
+
+    def __init__(self, max_entries=64, max_size=0x4000000):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        #: the total size of the cached entries
+        self.size = 0
+        #: the number of successful lookups
+        self.hits = 0
+        #: the number of failed lookups
+        self.misses = 0
+        # an ordered dictionary of (modified, value, size) keyed on
+        # snapshot ID, least recently used first
+        self._entries = collections.OrderedDict()
+
+    def get(self, sid, modified):
+        """Returns the cached value for snapshot *sid*
+
+        modified
+            The ModifiedDateTime of the snapshot, an
+            :class:`pyslet.iso8601.TimePoint` instance.
+
+        Returns None if there is no entry for *sid* or if the entry was
+        cached with a different modification time."""
+        with self.lock:
+            entry = self._entries.pop(sid, None)
+            if entry is not None:
+                if entry[0] == modified:
+                    # re-insert as the most recently used
+                    self._entries[sid] = entry
+                    self.hits += 1
+                    return entry[1]
+                # the snapshot has changed, discard the old entry
+                self.size -= entry[2]
+            self.misses += 1
+            return None
+
+    def set(self, sid, modified, value, size):
+        """Adds *value* to the cache
+
+        sid
+            The ID of the snapshot
+
+        modified
+            The ModifiedDateTime of the snapshot
+
+        value
+            The value to cache
+
+        size
+            The estimated size of *value* in bytes
+
+        Values larger than the size limit are not cached at all."""
+        if size > self.max_size:
+            logging.warning("Snapshot %i too large to cache (%i bytes)",
+                            sid, size)
+            return
+        with self.lock:
+            self.discard(sid)
+            self._entries[sid] = (modified, value, size)
+            self.size += size
+            while (len(self._entries) > self.max_entries or
+                    self.size > self.max_size):
+                old_sid, entry = self._entries.popitem(last=False)
+                self.size -= entry[2]
+                logging.debug("Evicted snapshot %i from cache", old_sid)
+
+    def discard(self, sid):
+        """Removes any entry for snapshot *sid* from the cache"""
+        with self.lock:
+            entry = self._entries.pop(sid, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def __len__(self):
+        with self.lock:
+            return len(self._entries)
+
+
+class SnapshotStore(object):
+
+    """A disk-backed store of AssessmentSnapshot data
+
+    path
+        The directory in which to store the data, it is created if
+        necessary.
+
+    max_size (1GB)
+        The approximate maximum number of bytes of data to store.
+
+    The store is content addressed: each snapshot's data is saved in a
+    file named after the SHA-256 digest of its content so identical
+    snapshots are only stored once, the digest also serves as a strong
+    ETag.  A small JSON file for each snapshot ID records the digest,
+    media type and size of the data along with the ModifiedDateTime of
+    the AssessmentSnapshot entity it was read from.
+
+    Files are written to a temporary location and moved into place when
+    complete so that readers never see partial data and the directory
+    can be shared by several processes and survives restarts.  The
+    modification time of a data file is updated each time it is opened
+    and, when the total size exceeds max_size, the least recently used
+    files are removed."""
+
+    #: the age, in seconds, after which an abandoned temporary file is
+    #: removed
+    TMP_MAX_AGE = 86400
+
+    def __init__(self, path, max_size=0x40000000):
+        self.path = path
+        self.max_size = max_size
+        for d in ('data', 'snapshots', 'tmp'):
+            try:
+                os.makedirs(os.path.join(path, d))
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        # clean up after any process that died while writing
+        tmp_dir = os.path.join(path, 'tmp')
+        now = time.time()
+        for name in os.listdir(tmp_dir):
+            tmp_path = os.path.join(tmp_dir, name)
+            try:
+                if os.stat(tmp_path).st_mtime < now - self.TMP_MAX_AGE:
+                    os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def data_path(self, digest):
+        """Returns the path of the file containing data with *digest*"""
+        return os.path.join(self.path, 'data', digest[:2], digest)
+
+    def _info_path(self, sid):
+        return os.path.join(self.path, 'snapshots', '%i.json' % sid)
+
+    def get(self, sid, modified):
+        """Returns information about the stored data of snapshot *sid*
+
+        modified
+            The ModifiedDateTime of the snapshot.
+
+        Returns a dictionary with keys "digest", "type" and "size" or
+        None if the data is not in the store or was stored with a
+        different modification time."""
+        info_path = self._info_path(sid)
+        try:
+            with open(info_path, 'rb') as f:
+                info = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if info.get('modified') != str(modified):
+            return None
+        if not os.path.exists(self.data_path(info['digest'])):
+            # evicted, remove the dangling record
+            try:
+                os.remove(info_path)
+            except OSError:
+                pass
+            return None
+        return info
+
+    def open(self, sid, modified):
+        """Opens the stored data of snapshot *sid*
+
+        modified
+            The ModifiedDateTime of the snapshot.
+
+        Returns a tuple of (info, data) where info is as returned by
+        :meth:`get` and data is a read-only :class:`mmap.mmap` of the
+        file, or None if the data is not available.  The caller must
+        close data when it is finished with it."""
+        info = self.get(sid, modified)
+        if info is None or not info['size']:
+            return None
+        data_path = self.data_path(info['digest'])
+        try:
+            with open(data_path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # mark as recently used
+            os.utime(data_path, None)
+        except (IOError, OSError, ValueError) as err:
+            logging.warning("SnapshotStore: failed to open %s: %s",
+                            data_path, str(err))
+            return None
+        return info, data
+
+    def new_writer(self, sid, modified, type):
+        """Returns a :class:`SnapshotWriter` for storing snapshot *sid*
+
+        type
+            The media type of the data, as a string"""
+        return SnapshotWriter(self, sid, modified, type)
+
+    def _commit(self, sid, info, tmp_path):
+        data_path = self.data_path(info['digest'])
+        try:
+            os.makedirs(os.path.dirname(data_path))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        if os.path.exists(data_path):
+            # we already have this data
+            os.remove(tmp_path)
+            os.utime(data_path, None)
+        else:
+            os.rename(tmp_path, data_path)
+        fd, info_tmp = tempfile.mkstemp(dir=os.path.join(self.path, 'tmp'))
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(info, f)
+        os.rename(info_tmp, self._info_path(sid))
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used data until within max_size"""
+        files = []
+        total = 0
+        for dir_path, dir_names, file_names in os.walk(
+                os.path.join(self.path, 'data')):
+            for name in file_names:
+                data_path = os.path.join(dir_path, name)
+                try:
+                    finfo = os.stat(data_path)
+                except OSError:
+                    # removed by another process
+                    continue
+                files.append((finfo.st_mtime, finfo.st_size, data_path))
+                total += finfo.st_size
+        if total <= self.max_size:
+            return
+        files.sort()
+        for mtime, size, data_path in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(data_path)
+                logging.debug("SnapshotStore: evicted %s", data_path)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            total -= size
+
+
+class SnapshotWriter(object):
+
+    """Writes snapshot data into a :class:`SnapshotStore`
+
+    Data is passed to :meth:`write` as it is received, :meth:`commit`
+    adds it to the store and :meth:`abort` discards it."""
+
+    def __init__(self, store, sid, modified, type):
+        self.store = store
+        self.sid = sid
+        self.info = {'modified': str(modified), 'type': type}
+        self.hash = hashlib.sha256()
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(
+            dir=os.path.join(store.path, 'tmp'))
+        self.f = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.f.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.f.close()
+        self.info['digest'] = self.hash.hexdigest()
+        self.info['size'] = self.size
+        self.store._commit(self.sid, self.info, self.tmp_path)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def tee(self, chunks):
+        """Generates *chunks*, writing a copy of each
+
+        The data is committed if all the chunks are generated and
+        aborted otherwise, for example, if the generator is closed
+        before it is exhausted."""
+        complete = False
+        try:
+            for chunk in chunks:
+                self.write(chunk)
+                yield chunk
+            complete = True
+            self.commit()
+        finally:
+            if not complete:
+                self.abort()
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+
+
+class ProxyStream(io.RawIOBase):
+
+    """Relays the body of an HTTP response as it is received
+
+    http_client
+        The :class:`pyslet.http.client.Client` used to send the request
+
+    Works in the same way as the pyslet OData client's EntityStream
+    but accepts any response status and allows the caller to set
+    arbitrary request headers.  Data is only read from the connection
+    as the generator returned by :meth:`data_gen` is consumed so at
+    most a few chunks are held in memory at any one time."""
+
+    #: the response statuses for which the body is relayed
+    RELAY_STATUS = (200, 206)
+
+    def __init__(self, http_client):
+        self.http_client = http_client
+        self.request = None
+        self.data = []
+
+    def start_request(self, request):
+        """Sends *request*, returns when the response status is known"""
+        self.request = request
+        self.http_client.queue_request(request)
+        while self.http_client.thread_task():
+            if self.data:
+                if self.request.response.status in self.RELAY_STATUS:
+                    break
+                else:
+                    # discard data received before the final response,
+                    # e.g., the body of an authentication challenge
+                    self.data = []
+        if self.status not in self.RELAY_STATUS:
+            self.data = []
+
+    @property
+    def status(self):
+        """The response status, 0 if no response was received"""
+        return self.request.response.status or self.request.status
+
+    def data_gen(self):
+        """Generates the body of the response"""
+        complete = False
+        try:
+            while self.data or self.http_client.thread_task():
+                for chunk in self.data:
+                    if chunk:
+                        yield chunk
+                self.data = []
+            complete = True
+        finally:
+            if not complete:
+                # drain the response to leave the connection usable
+                while self.http_client.thread_task():
+                    self.data = []
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, b):
+        if b:
+            self.data.append(str(b))
+        return len(b)
+
+
+class MeteredData(object):
+
+    """Times the receipt of data from the Delivery OData service
+
+    http_client
+        The :class:`DeliveryClient` receiving the data
+
+    data
+        An iterable of strings, typically a generator that reads them
+        from a connection as they are consumed
+
+    entity_set, operation
+        The labels used to record the call
+
+    elapsed (0.0)
+        The time already spent on the call in seconds, e.g., waiting
+        for the response status
+
+    Iterating over an instance yields the strings in data.  Only the
+    time spent waiting for each string is counted, not the time the
+    consumer spends on it, so data that is parsed or relayed as it
+    arrives is timed correctly.  The call is recorded with
+    :meth:`DeliveryClient.record_call` when the iteration ends."""
+
+    def __init__(self, http_client, data, entity_set, operation,
+                 elapsed=0.0):
+        self.http_client = http_client
+        self.data = data
+        self.entity_set = entity_set
+        self.operation = operation
+        self.elapsed = elapsed
+        self.size = 0
+
+    def __iter__(self):
+        chunks = iter(self.data)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    self.elapsed += time.time() - start
+                self.size += len(chunk)
+                yield chunk
+        finally:
+            self.http_client.record_call(self.entity_set, self.operation,
+                                         self.size, self.elapsed)
+
+
+class SnapshotIndex(object):
+
+    """An index of AssessmentSnapshot IDs keyed on AssessmentID
+
+    The index is used to find the snapshots of an assessment when the
+    service does not support filtering the AssessmentSnapshots
+    collection.  It is populated by :meth:`refresh` which reads only
+    the snapshots added since the last refresh.  Instances are thread
+    safe."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        #: the number of snapshots read from the service
+        self.count = 0
+        # a dictionary of snapshot ID sets keyed on AssessmentID
+        self._index = {}
+
+    def refresh(self, snapshots):
+        """Updates the index from the service
+
+        snapshots
+            An open AssessmentSnapshots collection
+
+        The size of the collection is checked using $count.  If it has
+        grown since the last refresh only the new snapshots are read,
+        assuming that new snapshots are added to the end of the
+        collection (i.e., in key order).  If the collection has shrunk,
+        or the size cannot be determined, the index is rebuilt."""
+        with self.lock:
+            try:
+                n = len(snapshots)
+            except client.UnexpectedHTTPResponse as err:
+                logging.warning("AssessmentSnapshots/$count failed: %s",
+                                str(err))
+                n = None
+            if n is not None and n == self.count:
+                return
+            if n is None or n < self.count:
+                logging.info("Rebuilding AssessmentSnapshots index")
+                self._index = {}
+                self.count = 0
+                for s in snapshots.itervalues():
+                    self.add(s['AssessmentID'].value, s['ID'].value)
+                    self.count += 1
+                return
+            snapshots.set_page(n - self.count, self.count)
+            while self.count < n:
+                nread = 0
+                for s in snapshots.iterpage(set_next=True):
+                    self.add(s['AssessmentID'].value, s['ID'].value)
+                    nread += 1
+                if not nread:
+                    break
+                self.count += nread
+
+    def add(self, aid, sid):
+        """Adds snapshot *sid* of assessment *aid* to the index"""
+        with self.lock:
+            self._index.setdefault(aid, set()).add(sid)
+
+    def discard(self, aid, sid):
+        """Removes snapshot *sid* of assessment *aid* from the index"""
+        with self.lock:
+            sids = self._index.get(aid, None)
+            if sids is not None:
+                sids.discard(sid)
+
+    def get_snapshot_ids(self, aid):
+        """Returns a sorted list of the snapshot IDs of assessment *aid*"""
+        with self.lock:
+            return sorted(self._index.get(aid, ()))
+
+
+class GroupCountCache(object):
+
+    """A cache of the number of participants in each group
+
+    ttl (300)
+        The maximum number of seconds for which a count is cached
+
+    Counts are cached against the group's ID along with a version, such
+    as the ModifiedDateTime of the Group entity, if available.  A lookup
+    with a different version discards the cached count.  Instances are
+    thread safe."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        # a dictionary of (version, expires, count) keyed on group ID
+        self._counts = {}
+
+    def get(self, gid, version=None):
+        """Returns the cached count for group *gid* or None"""
+        with self.lock:
+            entry = self._counts.get(gid, None)
+            if entry is not None:
+                if entry[0] == version and entry[1] > time.time():
+                    return entry[2]
+                del self._counts[gid]
+            return None
+
+    def set(self, gid, count, version=None):
+        """Caches *count* as the number of participants in group *gid*"""
+        with self.lock:
+            self._counts[gid] = (version, time.time() + self.ttl, count)
+
+    def discard(self, gid):
+        """Removes any cached count for group *gid*"""
+        with self.lock:
+            self._counts.pop(gid, None)
+
+
+class EntityCache(object):
+
+    """A read-through cache of entities from rarely changing entity sets
+
+    container
+        The entity container of the OData client
+
+    ttl
+        A dictionary mapping entity set names to the number of seconds
+        for which entities are cached.  Only entities from these entity
+        sets are cached.
+
+    max_entries (1024)
+        The maximum number of entities to keep in the cache.
+
+    An entity is returned from the cache without contacting the service
+    until its time to live expires.  After that, if the service supplied
+    an ETag with the entity, it is revalidated with a conditional GET
+    and only downloaded again if it has changed.  When the cache is full
+    the least recently used entities are evicted.  Instances are thread
+    safe, the cached entities are shared and must not be modified."""
+
+    def __init__(self, container, ttl, max_entries=1024):
+        self.container = container
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        #: the number of lookups answered from the cache
+        self.hits = 0
+        #: the number of lookups that required a download
+        self.misses = 0
+        #: the number of lookups answered by a conditional GET
+        self.revalidations = 0
+        # an ordered dictionary of [expires, etag, entity] keyed on
+        # (entity set name, key), least recently used first
+        self._entries = collections.OrderedDict()
+
+    def cached(self, name):
+        """Returns True if entities from entity set *name* are cached"""
+        return name in self.ttl
+
+    def get(self, name, key):
+        """Returns the entity with *key* from the entity set *name*
+
+        Raises KeyError if there is no such entity."""
+        now = time.time()
+        with self.lock:
+            entry = self._entries.pop((name, key), None)
+            if entry is not None:
+                self._entries[(name, key)] = entry
+                if entry[0] > now:
+                    self.hits += 1
+                    return entry[2]
+        try:
+            etag, entity = self._fetch(name, key,
+                                       entry[1] if entry else None)
+        except KeyError:
+            self.discard(name, key)
+            raise
+        with self.lock:
+            if entity is None:
+                self.revalidations += 1
+                entity = entry[2]
+            else:
+                self.misses += 1
+            self._entries.pop((name, key), None)
+            self._entries[(name, key)] = [now + self.ttl[name], etag, entity]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entity
+
+    def _fetch(self, name, key, etag):
+        # Returns a tuple of (etag, entity), entity is None if etag is
+        # given and the entity has not been modified
+        entity_set = self.container[name]
+        with entity_set.OpenCollection() as collection:
+            url = str(collection.baseURI) + odata.ODataURI.FormatKeyDict(
+                entity_set.GetKeyDict(key))
+            request = http.ClientRequest(url)
+            request.set_header('Accept', 'application/atom+xml;type=entry')
+            if etag is not None:
+                request.set_header('If-None-Match', etag)
+            collection.client.process_request(request)
+        if request.status == 404:
+            raise KeyError(key)
+        elif request.status == 304 and etag is not None:
+            return etag, None
+        elif request.status != 200:
+            raise client.UnexpectedHTTPResponse(
+                "%i %s" % (request.status, request.response.reason))
+        doc = odata.Document(baseURI=url)
+        doc.Read(request.res_body)
+        entity = odata.Entity(entity_set)
+        entity.exists = True
+        doc.root.GetValue(entity)
+        return request.response.get_header('ETag'), entity
+
+    def discard(self, name, key):
+        """Removes any cached entity with *key* from entity set *name*"""
+        with self.lock:
+            self._entries.pop((name, key), None)
+
+    def clear(self):
+        """Removes all entities from the cache"""
+        with self.lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self._entries)
+
+
+class FetchResult(object):
+
+    """The result of a call made without a thread pool
+
+    The call is made immediately and its result (or exception) is
+    saved.  Provides the same get method as the results returned by
+    :class:`multiprocessing.pool.ThreadPool`."""
+
+    def __init__(self, func, args, kwargs):
+        self.error = None
+        try:
+            self.value = func(*args, **kwargs)
+        except Exception as err:
+            self.value = None
+            self.error = err
+
+    def get(self, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class FetchGroup(object):
+
+    """A group of independent reads made concurrently
+
+    pool
+        The :class:`multiprocessing.pool.ThreadPool` used to make the
+        calls.  If None, each call is made immediately in the calling
+        thread.
+
+    metrics (None)
+        A :class:`Metrics` instance, calls made by the pool record
+        their steps in the trace of the calling thread.
+
+    A new group is created for each request.  The pyslet HTTP client
+    allocates connections to threads so reads submitted to the pool
+    are sent over separate connections in parallel and the total wait
+    is roughly that of the slowest read.  Calls submitted to a group
+    must not depend on each other and must not submit calls to the
+    same pool themselves."""
+
+    def __init__(self, pool=None, metrics=None):
+        self.pool = pool
+        self.metrics = metrics
+        self.results = []
+
+    def submit(self, func, *args, **kwargs):
+        """Submits a call of *func* with *args* and *kwargs*
+
+        Returns a result object, the value of the call is obtained
+        with its get method which re-raises any exception raised by
+        the call."""
+        if self.pool is None:
+            result = FetchResult(func, args, kwargs)
+        else:
+            if self.metrics is not None:
+                func = self.metrics.traced(func)
+            result = self.pool.apply_async(func, args, kwargs)
+        self.results.append(result)
+        return result
+
+    def join(self):
+        """Waits for all submitted calls
+
+        Returns a list of the values of the calls in the order in which
+        they were submitted.  If any call raised an exception the first
+        such exception is raised."""
+        return [r.get() for r in self.results]
+
+
+class SingleFlight(object):
+
+    """Coalesces identical concurrent reads
+
+    metrics (None)
+        A :class:`Metrics` instance in which to count the reads
+
+    Reads are identified by a key tuple of (entity set name, entity
+    key, query options).  While a read is in flight any identical read
+    waits for it and shares its result, or its exception, instead of
+    making its own call to the service.  Results are not kept once the
+    read has finished.  Shared results must not be modified.  Instances
+    are thread safe."""
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        #: the number of reads, keyed on entity set name
+        self.reads = collections.defaultdict(int)
+        #: the number of reads that shared another read's call, keyed on
+        #: entity set name
+        self.collapsed = collections.defaultdict(int)
+        # a dictionary of [event, result, error] keyed on read key
+        self._in_flight = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Returns the result of calling *func* for read *key*
+
+        If a read with the same key is already in flight this call
+        waits for it instead of calling *func*."""
+        name = key[0]
+        with self.lock:
+            self.reads[name] += 1
+            call = self._in_flight.get(key, None)
+            if call is None:
+                call = [threading.Event(), None, None]
+                self._in_flight[key] = call
+                leader = True
+            else:
+                self.collapsed[name] += 1
+                leader = False
+        if self.metrics is not None:
+            self.metrics.increment('dodata_reads_total', entity_set=name)
+            if not leader:
+                self.metrics.increment('dodata_collapsed_reads_total',
+                                       entity_set=name)
+        if not leader:
+            start = time.time()
+            call[0].wait()
+            if self.metrics is not None:
+                self.metrics.add_step(
+                    "wait for %s %s" % (name, repr(key[1])),
+                    time.time() - start)
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = func(*args, **kwargs)
+            return call[1]
+        except Exception as err:
+            call[2] = err
+            raise
+        finally:
+            with self.lock:
+                del self._in_flight[key]
+            call[0].set()
+
+    def get_stats(self):
+        """Returns a dictionary of statistics
+
+        The result maps entity set names onto dictionaries with the
+        number of reads and the number of those that shared another
+        read's call (collapsed)."""
+        with self.lock:
+            return dict((name, {'reads': n,
+                                'collapsed': self.collapsed.get(name, 0)})
+                        for name, n in self.reads.items())
+
+
+class Prefetcher(object):
+
+    """Runs warm-up tasks in the background
+
+    threads (2)
+        The number of threads that run tasks
+
+    max_tasks (100)
+        The maximum number of tasks waiting to run, tasks submitted
+        when the queue is full are dropped.
+
+    busy (None)
+        A function that returns True while interactive requests are
+        being served.  Tasks are held back until it returns False, or
+        for at most :attr:`max_delay` seconds.
+
+    Tasks only warm caches so they are dropped rather than allowed to
+    build up, and a failed task is just logged."""
+
+    #: the longest a task is held back by interactive requests
+    max_delay = 5.0
+
+    #: the interval at which a held back task checks again
+    poll_interval = 0.05
+
+    def __init__(self, threads=2, max_tasks=100, busy=None):
+        self.busy = busy
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(max_tasks)
+        #: the number of tasks run
+        self.completed = 0
+        #: the number of tasks dropped because the queue was full
+        self.dropped = 0
+        # the keys of the tasks waiting to run
+        self._pending = set()
+        for i in range(threads):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queues a call of *func* with *args* and *kwargs*
+
+        key
+            Identifies the task, a task is not queued if a task with the
+            same key is already waiting to run.
+
+        Returns True if the task was queued."""
+        with self.lock:
+            if key in self._pending:
+                return False
+            try:
+                self.queue.put_nowait((key, func, args, kwargs))
+            except Queue.Full:
+                self.dropped += 1
+                logging.warning("Prefetch queue full, dropped %s", repr(key))
+                return False
+            self._pending.add(key)
+        return True
+
+    def run(self):
+        while True:
+            key, func, args, kwargs = self.queue.get()
+            if self.busy is not None:
+                deadline = time.time() + self.max_delay
+                while self.busy() and time.time() < deadline:
+                    time.sleep(self.poll_interval)
+            with self.lock:
+                self._pending.discard(key)
+            try:
+                func(*args, **kwargs)
+            except Exception as err:
+                logging.warning("Prefetch of %s failed: %s", repr(key),
+                                str(err))
+            with self.lock:
+                self.completed += 1
+
+    def get_stats(self):
+        """Returns a dictionary of statistics
+
+        The number of tasks waiting to run (queued), run (completed)
+        and dropped because the queue was full (dropped)."""
+        with self.lock:
+            return {'queued': len(self._pending),
+                    'completed': self.completed, 'dropped': self.dropped}
+
+
+class EntityPage(object):
+
+    """A lazily loaded page of entities for use in templates
+
+    entity_set
+        The entity set to read from
+
+    param
+        The name of the query parameter that holds the (0-based) page
+        number
+
+    query
+        A dictionary of the current request's query parameters
+
+    page_size (50)
+        The number of entities on a page
+
+    select (None)
+        An optional dictionary of the properties to select, in the
+        format used by the OData collection's set_expand method.
+
+    The entities are only requested from the service when the page is
+    iterated, using the $top and $skip system query options and
+    following any server-driven paging links.  After iteration the
+    attribute :attr:`more` indicates whether or not there is a next
+    page.  The attributes :attr:`prev_query` and :attr:`next_query`
+    contain the query strings for links to the neighbouring pages.
+
+    Alternatively, :meth:`load` can be called to read the page in
+    advance, for example, from a :class:`FetchGroup`."""
+
+    def __init__(self, entity_set, param, query, page_size=50, select=None):
+        self.entity_set = entity_set
+        self.param = param
+        self.query = query
+        self.page_size = page_size
+        self.select = select
+        try:
+            #: the 0-based page number
+            self.page = max(int(query.get(param, 0)), 0)
+        except ValueError:
+            self.page = 0
+        #: True if there are more entities after this page
+        self.more = False
+        # the list of entities, if loaded in advance
+        self.entities = None
+
+    def load(self):
+        """Reads the entities on this page into a list"""
+        self.entities = list(self._read())
+
+    def __iter__(self):
+        if self.entities is None:
+            return self._read()
+        else:
+            return iter(self.entities)
+
+    def _read(self):
+        n = 0
+        with self.entity_set.OpenCollection() as collection:
+            if self.select is not None:
+                collection.set_expand(None, self.select)
+            # request one extra entity to find out if there are more
+            collection.set_page(self.page_size + 1,
+                                self.page * self.page_size)
+            while True:
+                nread = 0
+                for entity in collection.iterpage(set_next=True):
+                    nread += 1
+                    n += 1
+                    if n > self.page_size:
+                        self.more = True
+                        return
+                    yield entity
+                if not nread or collection.nextSkiptoken is None:
+                    break
+
+    def _page_query(self, page):
+        query = dict(self.query)
+        query[self.param] = str(page)
+        return urllib.urlencode(query)
+
+    @property
+    def prev_query(self):
+        """The query string for the previous page"""
+        return self._page_query(max(self.page - 1, 0))
+
+    @property
+    def next_query(self):
+        """The query string for the next page"""
+        return self._page_query(self.page + 1)
+
+
+class AttemptIndex(object):
+
+    """An index of Attempt IDs keyed on print batch and participant
+
+    max_batches (64)
+        The maximum number of print batches to index
+
+    The index covers the attempts created for uploading scanned answers,
+    i.e., those with an ExternalAttemptID of the form "PAS:<bid>:<pid>".
+    A batch is marked as loaded once all of its attempts have been read
+    from the service, attempts created later are added as they are
+    created.  When the limit is exceeded the least recently used batches
+    are dropped.  Instances are thread safe."""
+
+    def __init__(self, max_batches=64):
+        self.max_batches = max_batches
+        self.lock = threading.RLock()
+        # an ordered dictionary of [loaded, {pid: attempt ID}] keyed on
+        # batch ID, least recently used first
+        self._batches = collections.OrderedDict()
+
+    def _get_batch(self, bid, create=False):
+        entry = self._batches.pop(bid, None)
+        if entry is None:
+            if not create:
+                return None
+            entry = [False, {}]
+        self._batches[bid] = entry
+        while len(self._batches) > self.max_batches:
+            self._batches.popitem(last=False)
+        return entry
+
+    def loaded(self, bid):
+        """Returns True if all the attempts of batch *bid* are indexed"""
+        with self.lock:
+            entry = self._get_batch(bid)
+            return entry is not None and entry[0]
+
+    def get(self, bid, pid):
+        """Returns the ID of participant *pid*'s attempt or None"""
+        with self.lock:
+            entry = self._get_batch(bid)
+            if entry is None:
+                return None
+            return entry[1].get(pid, None)
+
+    def get_batch(self, bid):
+        """Returns a dictionary of attempt IDs keyed on participant ID
+
+        Returns None if batch *bid* is not loaded."""
+        with self.lock:
+            entry = self._get_batch(bid)
+            if entry is None or not entry[0]:
+                return None
+            return dict(entry[1])
+
+    def set_batch(self, bid, attempts):
+        """Sets all the attempts of batch *bid*
+
+        attempts
+            A dictionary of attempt IDs keyed on participant ID"""
+        with self.lock:
+            entry = self._get_batch(bid, True)
+            entry[0] = True
+            entry[1] = dict(attempts)
+
+    def add(self, bid, pid, attempt_id):
+        """Adds the attempt of participant *pid* in batch *bid*"""
+        with self.lock:
+            self._get_batch(bid, True)[1][pid] = attempt_id
+
+    def discard(self, bid, pid):
+        """Removes the attempt of participant *pid* in batch *bid*"""
+        with self.lock:
+            entry = self._batches.get(bid, None)
+            if entry is not None:
+                entry[1].pop(pid, None)
+
+
+class AnswerUploader(object):
+
+    """Uploads scanned answers for the participants of a print batch
+
+    container
+        The entity container of the OData client
+
+    bid, aid, sid
+        The IDs of the PrintBatch, its Assessment and AssessmentSnapshot
+
+    key
+        The :class:`aml.AnswerKey` of the snapshot
+
+    index (None)
+        An optional :class:`AttemptIndex` used to look up attempts
+        without contacting the service.
+
+    Each participant's answers are uploaded to an Attempt identified by
+    the ExternalAttemptID "PAS:<bid>:<pid>", the attempt is created if
+    it does not exist yet.  The responses are decoded with an
+    :class:`aml.SheetDecoder`.  Instances are thread safe."""
+
+    def __init__(self, container, bid, aid, sid, key, index=None):
+        self.container = container
+        self.bid = bid
+        self.aid = aid
+        self.sid = sid
+        self.key = key
+        self.decoder = aml.SheetDecoder(key)
+        if index is None:
+            index = AttemptIndex(1)
+        self.index = index
+        # the filter used to find a single attempt, compiled on first
+        # use in each thread as the parameter value is bound to the
+        # expression.  Created here rather than in the class so that it
+        # is local to each greenlet once gevent has patched threading
+        self._local = threading.local()
+
+    #: whether or not the service supports the startswith filter used
+    #: by :meth:`find_attempts`, shared by all instances, None if not
+    #: yet known
+    attempt_filter = None
+
+    def xid_filter(self, xid):
+        """Returns a filter that selects ExternalAttemptID *xid*
+
+        The filter expression is only parsed once per thread, each call
+        re-binds the parameter and so invalidates the filter returned by
+        the previous call in the same thread."""
+        local = self._local
+        if getattr(local, 'xid_filter', None) is None:
+            local.xid_value = odata.edm.EDMValue.NewSimpleValue(
+                odata.edm.SimpleType.String)
+            parser = odata.Parser("ExternalAttemptID eq :xid")
+            local.xid_filter = parser.parse_common_expression(
+                {'xid': local.xid_value})
+        local.xid_value.set_from_value(xid)
+        return local.xid_filter
+
+    @staticmethod
+    def read_responses(src):
+        """Reads a file of responses
+
+        src
+            A file-like object containing comma separated values.  Each
+            line contains a participant ID followed by the letters of
+            the choices selected for each question in turn, for example,
+            "1234,A,BC,,D".  Lines that do not start with an integer,
+            such as a header line, are ignored.
+
+        Returns a list of (participant ID, list of responses) tuples."""
+        responses = []
+        for row in csv.reader(src):
+            if not row or not row[0].strip().isdigit():
+                continue
+            responses.append(
+                (long(row[0]), [r.strip().upper() for r in row[1:]]))
+        return responses
+
+    def external_id(self, pid):
+        """Returns the ExternalAttemptID for participant *pid*"""
+        return "PAS:%i:%i" % (self.bid, pid)
+
+    def find_attempt(self, pid):
+        """Returns the ID of participant *pid*'s attempt or None
+
+        The attempt is looked up in the :attr:`index`, loading all the
+        attempts of the batch with :meth:`find_attempts` if necessary
+        and supported.  If the batch was loaded by an earlier request
+        the attempt may have been created since so the service is
+        checked with :meth:`lookup_attempt` before returning None."""
+        attempt_id = self.index.get(self.bid, pid)
+        if attempt_id is not None:
+            return attempt_id
+        if (self.attempt_filter is not False and
+                not self.index.loaded(self.bid)):
+            attempts = self.find_attempts()
+            if attempts is not None:
+                # freshly loaded
+                return attempts.get(pid, None)
+        return self.lookup_attempt(pid)
+
+    def lookup_attempt(self, pid):
+        """Returns the ID of participant *pid*'s attempt or None
+
+        The attempt is always looked up with a single query, the result
+        is added to the :attr:`index`."""
+        with self.container['Attempts'].OpenCollection() as attempts:
+            attempts.set_filter(self.xid_filter(self.external_id(pid)))
+            attempts.set_page(1)
+            attempt = list(attempts.iterpage())
+        if attempt:
+            attempt_id = attempt[0]['ID'].value
+            self.index.add(self.bid, pid, attempt_id)
+            return attempt_id
+        return None
+
+    def find_attempts(self):
+        """Returns the IDs of the existing Attempts for this batch
+
+        The attempts are taken from the :attr:`index` if the batch has
+        been loaded, otherwise all attempts are found with a single
+        query and the index is updated.  The result is a dictionary of
+        attempt IDs keyed on participant ID or None if the query fails.
+        If the service rejects the query this is recorded in
+        :attr:`attempt_filter` and the query is not tried again."""
+        result = self.index.get_batch(self.bid)
+        if result is not None:
+            return result
+        if self.attempt_filter is False:
+            return None
+        with self.container['Attempts'].OpenCollection() as attempts:
+            # method call arguments cannot be parameters so we use a
+            # literal, the batch ID is an integer so needs no escaping
+            parser = odata.Parser(
+                "startswith(ExternalAttemptID,'PAS:%i:')" % self.bid)
+            attempts.set_filter(parser.parse_common_expression())
+            attempts.set_expand(None, {'ExternalAttemptID': None})
+            try:
+                result = {}
+                for attempt in attempts.itervalues():
+                    xid = attempt['ExternalAttemptID'].value
+                    pid = xid.split(':')[-1]
+                    if (pid.isdigit() and
+                            xid == self.external_id(long(pid))):
+                        result[long(pid)] = attempt['ID'].value
+            except client.UnexpectedHTTPResponse as err:
+                logging.warning("Attempts: startswith filter failed: %s",
+                                str(err))
+                if (self.attempt_filter is None and
+                        DeliveryClient.rejected(err)):
+                    logging.info("Attempts: startswith unsupported")
+                    AnswerUploader.attempt_filter = False
+                return None
+        if self.attempt_filter is None:
+            logging.info("Attempts: startswith supported")
+            AnswerUploader.attempt_filter = True
+        self.index.set_batch(self.bid, result)
+        return result
+
+    def new_attempt(self, pid):
+        """Creates a new Attempt for participant *pid*, returns its ID"""
+        with self.container['Attempts'].OpenCollection() as attempts:
+            attempt = attempts.new_entity()
+            attempt['ID'].set_from_value(0)
+            attempt['ExternalAttemptID'].set_from_value(self.external_id(pid))
+            attempt['ParticipantID'].set_from_value(pid)
+            attempt['AssessmentID'].set_from_value(self.aid)
+            attempt['AssessmentSnapshotID'].set_from_value(self.sid)
+            attempt['LockRequired'].set_from_value(True)
+            attempt['LockStatus'].set_from_value(True)
+            attempt['LastModifiedDateTime'].set_from_value(
+                iso.TimePoint.from_now())
+            attempts.insert_entity(attempt)
+        attempt_id = attempt['ID'].value
+        self.index.add(self.bid, pid, attempt_id)
+        return attempt_id
+
+    def new_answer_upload(self, responses):
+        """Returns the answer upload for a participant's responses
+
+        responses
+            A list of strings containing the letters of the choices
+            selected in each question, in question order.  Missing
+            responses are treated as blank.
+
+        The result is a dictionary suitable for serialising as JSON, the
+        AttemptID must be added by the caller."""
+        return self.decoder.decode([responses]).answer_upload(0)
+
+    def decode(self, responses):
+        """Decodes the responses of many participants at once
+
+        responses
+            A list of (participant ID, list of responses) tuples as
+            returned by :meth:`read_responses`.
+
+        Returns an :class:`aml.DecodedSheets` instance with one sheet
+        for each item in responses, in the same order."""
+        return self.decoder.decode([r for pid, r in responses])
+
+    def upload(self, pid, responses, attempt_id=None, answer_upload=None):
+        """Uploads the responses of participant *pid*
+
+        attempt_id (None)
+            The ID of the participant's Attempt, if already known.  If
+            None the attempt is looked up and, if necessary, created.
+
+        answer_upload (None)
+            The answer upload for responses if they have already been
+            decoded, it is modified by this method.
+
+        Returns a tuple of (attempt ID, answer upload)."""
+        if attempt_id is None:
+            attempt_id = self.find_attempt(pid)
+            if attempt_id is None:
+                attempt_id = self.new_attempt(pid)
+        if answer_upload is None:
+            answer_upload = self.new_answer_upload(responses)
+        answer_upload['AttemptID'] = unicode(attempt_id)
+        with self.container['AnswerUploads'].OpenCollection() as uploads:
+            sinfo = odata.StreamInfo(
+                type=params.MediaType.from_str('application/json'))
+            sdata = StringIO.StringIO(
+                json.dumps(answer_upload).encode("utf-8"))
+            uploads.new_stream(sdata, sinfo=sinfo)
+        return attempt_id, answer_upload
+
+    def upload_all(self, responses, threads=4, retries=3, sheets=None):
+        """Uploads the responses of many participants concurrently
+
+        responses
+            A list of (participant ID, list of responses) tuples as
+            returned by :meth:`read_responses`.
+
+        threads (4)
+            The number of uploads to run at the same time
+
+        retries (3)
+            The number of times to retry a failed upload.  Uploads that
+            fail because of an error in the request itself, such as an
+            unknown participant, are not retried.
+
+        sheets (None)
+            The result of calling :meth:`decode` with responses, if
+            None the responses are decoded by this method.
+
+        The existing attempts are found with :meth:`find_attempts` first,
+        if that fails each attempt is found with :meth:`lookup_attempt`
+        instead.  This method is a generator, yielding a tuple of (participant ID,
+        error message) as each upload finishes, the error message is
+        None if the upload was successful."""
+        attempts = self.find_attempts()
+        if attempts is None:
+            # look up each attempt separately
+            attempts = {}
+            lookup = True
+        else:
+            lookup = False
+        if sheets is None:
+            sheets = self.decode(responses)
+        tasks = [(pid, r, attempts.get(pid, None), lookup, retries, sheets, i)
+                 for i, (pid, r) in enumerate(responses)]
+        pool = ThreadPool(threads)
+        try:
+            for result in pool.imap_unordered(self._upload_task, tasks):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _upload_task(self, args):
+        pid, responses, attempt_id, lookup, retries, sheets, i = args
+        try:
+            tries = 0
+            while True:
+                try:
+                    if attempt_id is None and lookup:
+                        attempt_id = self.lookup_attempt(pid)
+                    if attempt_id is None:
+                        attempt_id = self.new_attempt(pid)
+                    self.upload(pid, responses, attempt_id,
+                                sheets.answer_upload(i))
+                    return pid, None
+                except (KeyError, NotImplementedError,
+                        odata.edm.ConstraintError,
+                        client.AuthorizationRequired):
+                    # client errors, retrying won't help
+                    raise
+                except Exception as err:
+                    if tries >= retries:
+                        raise
+                    tries += 1
+                    logging.warning("Upload for participant %i failed, "
+                                    "retrying: %s", pid, str(err))
+                    # the attempt may have been created regardless
+                    lookup = True
+                    time.sleep(0.5 * 2 ** tries)
+        except Exception as err:
+            logging.error("Upload for participant %i failed: %s",
+                          pid, str(err))
+            return pid, str(err) or err.__class__.__name__
+
 
-import aml
+class BatchManifest(object):
 
+    """Everything the batch pages need to know about a PrintBatch
+
+    container
+        The entity container of the OData client
+
+    obj
+        The manifest as a dictionary parsed from JSON, as returned by
+        :meth:`to_json_object`.
+
+    A manifest records the PrintBatch, its Group, AssessmentSnapshot
+    and Assessment, the Participants in the group and the answer key of
+    the snapshot.  The entities are recreated from their JSON
+    representations when first used, they are shared and must not be
+    modified."""
+
+    def __init__(self, container, obj):
+        self.container = container
+        self.obj = obj
+        self._entities = {}
+        self._participants = None
+        self._key = None
+
+    @classmethod
+    def new(cls, container, b, g, s, a, participants, key):
+        """Creates a new manifest
+
+        b, g, s, a
+            The PrintBatch and its Group, AssessmentSnapshot and
+            Assessment entities
+
+        participants
+            A list of the Participant entities in the group
+
+        key
+            The :class:`aml.AnswerKey` of the snapshot"""
+        obj = {'bid': b['ID'].value,
+               'versions': cls.get_versions(b, g, s),
+               'validated': time.time(),
+               'batch': cls.entity_json(b),
+               'group': cls.entity_json(g),
+               'snapshot': cls.entity_json(s),
+               'assessment': cls.entity_json(a),
+               'participants': [cls.entity_json(p) for p in participants],
+               'key': key.to_json_object()}
+        manifest = cls(container, obj)
+        manifest._entities = {'batch': b, 'group': g, 'snapshot': s,
+                              'assessment': a}
+        manifest._participants = list(participants)
+        manifest._key = key
+        return manifest
+
+    @staticmethod
+    def get_versions(b, g, s):
+        """Returns the versions of a PrintBatch, Group and Snapshot
+
+        The result is a list of the ModifiedDateTime values formatted as
+        strings, the Group's value is None if it has no
+        ModifiedDateTime."""
+        if 'ModifiedDateTime' in g:
+            gmodified = str(g['ModifiedDateTime'].value)
+        else:
+            gmodified = None
+        return [str(b['ModifiedDateTime'].value), gmodified,
+                str(s['ModifiedDateTime'].value)]
+
+    @staticmethod
+    def entity_json(entity):
+        """Returns the JSON representation of *entity* as a dictionary"""
+        return json.loads(''.join(entity.generate_entity_type_in_json()))
+
+    def to_json_object(self):
+        """Returns the manifest as a dictionary suitable for JSON"""
+        return self.obj
+
+    @property
+    def bid(self):
+        """The ID of the PrintBatch"""
+        return self.obj['bid']
+
+    @property
+    def versions(self):
+        """The versions recorded in the manifest, see
+        :meth:`get_versions`"""
+        return self.obj['versions']
+
+    @property
+    def validated(self):
+        """The time at which the manifest was last known to be current"""
+        return self.obj['validated']
+
+    def _load(self, name, obj):
+        with self.container[name].OpenCollection() as collection:
+            entity = collection.new_entity()
+        entity.exists = True
+        entity.set_from_json_object(obj)
+        return entity
+
+    def _get_entity(self, item, name):
+        entity = self._entities.get(item, None)
+        if entity is None:
+            entity = self._load(name, self.obj[item])
+            self._entities[item] = entity
+        return entity
+
+    @property
+    def batch(self):
+        """The PrintBatch entity"""
+        return self._get_entity('batch', 'PrintBatches')
+
+    @property
+    def group(self):
+        """The Group entity"""
+        return self._get_entity('group', 'Groups')
+
+    @property
+    def snapshot(self):
+        """The AssessmentSnapshot entity"""
+        return self._get_entity('snapshot', 'AssessmentSnapshots')
+
+    @property
+    def assessment(self):
+        """The Assessment entity"""
+        return self._get_entity('assessment', 'Assessments')
+
+    @property
+    def participants(self):
+        """A list of the Participant entities in the Group"""
+        if self._participants is None:
+            self._participants = [self._load('Participants', p) for p in
+                                  self.obj['participants']]
+        return self._participants
+
+    @property
+    def participant_ids(self):
+        """A list of the IDs of the Participants in the Group"""
+        return [p['ID'].value for p in self.participants]
+
+    def get_participant(self, pid):
+        """Returns the Participant entity with ID *pid*
+
+        Raises KeyError if the participant is not in the Group."""
+        for p in self.participants:
+            if p['ID'].value == pid:
+                return p
+        raise KeyError(pid)
+
+    @property
+    def key(self):
+        """The :class:`aml.AnswerKey` of the AssessmentSnapshot"""
+        if self._key is None:
+            self._key = aml.AnswerKey.from_json_object(self.obj['key'])
+        return self._key
+
+
+class BatchManifestStore(object):
+
+    """A store of :class:`BatchManifest` instances
+
+    container
+        The entity container used to recreate manifests
+
+    path (None)
+        The directory in which to save manifests, it is created if
+        necessary.  If None, manifests are only kept in memory.
+
+    ttl (60)
+        The number of seconds for which a manifest may be used before
+        its versions must be checked against the service again
+
+    max_entries (64)
+        The maximum number of manifests to keep in memory
+
+    Manifests are saved as JSON files named after the batch ID.  Files
+    are written to a temporary name and moved into place so the
+    directory can be shared by several processes and survives restarts.
+    The most recently used manifests are also kept in memory, with
+    their entities, to save reading and parsing the files.  Instances
+    are thread safe."""
+
+    def __init__(self, container, path=None, ttl=60, max_entries=64):
+        self.container = container
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        # an ordered dictionary of manifests keyed on batch ID, least
+        # recently used first
+        self._manifests = collections.OrderedDict()
+        if path is not None:
+            try:
+                os.makedirs(path)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, bid):
+        return os.path.join(self.path, '%i.json' % bid)
+
+    def _remember(self, bid, manifest):
+        with self.lock:
+            self._manifests.pop(bid, None)
+            self._manifests[bid] = manifest
+            while len(self._manifests) > self.max_entries:
+                self._manifests.popitem(last=False)
+
+    def get(self, bid):
+        """Returns the manifest of PrintBatch *bid* or None"""
+        with self.lock:
+            manifest = self._manifests.get(bid, None)
+            if manifest is not None:
+                self._remember(bid, manifest)
+                return manifest
+        if self.path is None:
+            return None
+        try:
+            with open(self._path(bid), 'rb') as f:
+                obj = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if obj.get('bid') != bid:
+            return None
+        manifest = BatchManifest(self.container, obj)
+        self._remember(bid, manifest)
+        return manifest
+
+    def set(self, manifest):
+        """Saves *manifest*, replacing any existing manifest"""
+        self._remember(manifest.bid, manifest)
+        if self.path is None:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(manifest.to_json_object(), f)
+        os.rename(tmp_path, self._path(manifest.bid))
+
+    def stale(self, manifest):
+        """Returns True if *manifest* needs revalidating"""
+        return manifest.validated + self.ttl < time.time()
+
+    def revalidated(self, manifest):
+        """Records that *manifest* has been found to be current"""
+        manifest.obj['validated'] = time.time()
+        self.set(manifest)
+
+    def discard(self, bid):
+        """Removes the manifest of PrintBatch *bid*"""
+        with self.lock:
+            self._manifests.pop(bid, None)
+        if self.path is not None:
+            try:
+                os.remove(self._path(bid))
+            except OSError:
+                pass
+
+
+class SheetRenderer(object):
+
+    """Renders personalised scan sheets for a print batch
+
+    key
+        The :class:`aml.AnswerKey` of the batch's snapshot
+
+    batch_name
+        The name of the print batch, printed on each sheet
+
+    Instances are callable and can be pickled so they can be passed,
+    together with a chunk of participants, to the processes of a
+    :class:`multiprocessing.Pool`.  Each process loads and compiles the
+    template once."""
+
+    #: the template used for each sheet
+    template_name = 'batchsheet.html'
+
+    def __init__(self, key, batch_name):
+        self.key = key
+        self.batch_name = batch_name
+
+    def __call__(self, participants):
+        """Renders the sheets of *participants*
+
+        participants
+            A list of (participant ID, participant name) tuples
+
+        Returns the sheets as a UTF-8 encoded string."""
+        template = get_template(self.template_name)
+        sheets = []
+        for pid, name in participants:
+            sheets.append(template.render(Context({
+                'batch_name': self.batch_name, 'pid': pid, 'name': name,
+                'prefix': "p%i" % pid, 'qlist': self.key})))
+        return u''.join(sheets).encode('utf-8')
+
+    def render_all(self, participants, pool=None, chunk_size=8,
+                   window=8):
+        """Renders the sheets of a whole batch
+
+        participants
+            An iterable of (participant ID, participant name) tuples
+
+        pool (None)
+            A :class:`multiprocessing.Pool` used to render chunks of
+            sheets in parallel.  If None, sheets are rendered in the
+            calling thread.
+
+        chunk_size (8)
+            The number of sheets rendered by each call
+
+        window (8)
+            The maximum number of chunks being rendered, or waiting to
+            be generated, at any one time.
+
+        This method is a generator, yielding each chunk of sheets as a
+        string in the order of *participants* as soon as it is ready.
+        At most *window* chunks are held in memory however long the
+        batch."""
+        chunks = self.split(participants, chunk_size)
+        if pool is None:
+            for chunk in chunks:
+                yield self(chunk)
+                # give other requests a turn when serving with gevent
+                time.sleep(0)
+            return
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(self, (chunk, )))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    @staticmethod
+    def split(participants, chunk_size):
+        chunk = []
+        for p in participants:
+            chunk.append(p)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+class MetadataCache(object):
+
+    """A local copy of a service's service and metadata documents
+
+    path
+        The directory in which to keep the copies, it is created if
+        necessary.
+
+    ttl (300)
+        The number of seconds after which the copies should be
+        revalidated against the live service.
+
+    The documents are saved with an xml:base attribute pointing to
+    their original location, as required by the pyslet client's
+    LoadService method when reading from local files.  A JSON file,
+    named after the service URL, records the names of the copies, the
+    SHA-256 digest of the live documents and the time they were last
+    validated.  Files are written to temporary names and moved into
+    place, so the directory can be shared by several processes."""
+
+    def __init__(self, path, ttl=300):
+        self.path = path
+        self.ttl = ttl
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def _info_path(self, url):
+        return os.path.join(
+            self.path, hashlib.sha256(str(url)).hexdigest() + '.json')
+
+    def get(self, url):
+        """Returns information about the cached documents for *url*
+
+        Returns a dictionary with keys "service" and "metadata", the
+        paths of the local copies, "digest" and "validated" or None if
+        the service is not cached."""
+        try:
+            with open(self._info_path(url), 'rb') as f:
+                info = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if info.get('url') != str(url):
+            return None
+        for name in ('service', 'metadata'):
+            info[name] = os.path.join(self.path, info[name])
+        return info
+
+    def stale(self, info):
+        """Returns True if the documents in *info* need revalidating"""
+        return info['validated'] + self.ttl < time.time()
+
+    def update(self, http_client, url):
+        """Revalidates the cached documents for *url*
+
+        http_client
+            The :class:`pyslet.http.client.Client` used to download the
+            documents.
+
+        The documents are downloaded from the service and, if they have
+        changed, the local copies are replaced.  Returns True if the
+        documents changed (or were not cached), False otherwise."""
+        service_data = self._download(http_client, url,
+                                      'application/atomsvc+xml')
+        doc = odata.Document(baseURI=url)
+        doc.Read(src=service_data)
+        if not isinstance(doc.root, atompub.Service):
+            raise client.InvalidServiceDocument(str(url))
+        service_root = URI.from_octets(doc.root.ResolveBase())
+        metadata_url = URI.from_octets('$metadata').resolve(service_root)
+        metadata_data = self._download(http_client, metadata_url,
+                                       'application/xml')
+        digest = hashlib.sha256()
+        digest.update(service_data)
+        digest.update(metadata_data)
+        digest = digest.hexdigest()
+        info = self.get(url)
+        if info is not None and info['digest'] == digest:
+            self._save_info(url, info, time.time())
+            return False
+        # save copies that carry their original location
+        doc.root.SetBase(str(service_root))
+        service_name = self._save(digest + '-service.xml', str(doc))
+        doc = edmx.Document(baseURI=metadata_url)
+        doc.Read(src=metadata_data)
+        doc.root.SetBase(str(metadata_url))
+        metadata_name = self._save(digest + '-metadata.xml', str(doc))
+        self._save_info(url, {'url': str(url), 'digest': digest,
+                              'service': service_name,
+                              'metadata': metadata_name}, time.time())
+        if info is not None:
+            for old_path, name in ((info['service'], service_name),
+                                   (info['metadata'], metadata_name)):
+                if os.path.basename(old_path) == name:
+                    continue
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+        return True
+
+    def _download(self, http_client, url, type):
+        request = http.ClientRequest(str(url))
+        request.set_header('Accept', type)
+        http_client.process_request(request)
+        if request.status != 200:
+            raise client.UnexpectedHTTPResponse(
+                "%i %s" % (request.status,
+                           request.response.reason if request.response
+                           else ''))
+        return request.res_body
+
+    def _save(self, name, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, os.path.join(self.path, name))
+        return name
+
+    def _save_info(self, url, info, validated):
+        info = {'url': info['url'], 'digest': info['digest'],
+                'service': os.path.basename(info['service']),
+                'metadata': os.path.basename(info['metadata']),
+                'validated': validated}
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(info, f)
+        os.rename(tmp_path, self._info_path(url))
+
+
+class DeliverySecureConnection(http.SecureConnection):
+
+    """A secure connection wrapped with its client's SSLContext
+
+    Replaces pyslet's own new_socket, setting the same private
+    attributes (socket and socketTransport) as the version in pyslet
+    0.6.20160201."""
+
+    def new_socket(self):
+        http.Connection.new_socket(self)
+        try:
+            with self.lock:
+                if self.socket is not None:
+                    self.socket.setblocking(True)
+                    socket_ssl = self.manager.ssl_context.wrap_socket(
+                        self.socket, server_hostname=self.host)
+                    self.socketTransport = self.socket
+                    self.socket.setblocking(False)
+                    self.socket = socket_ssl
+                    logging.info(
+                        "Connected to %s with %s, %s, key length %i",
+                        self.host, *self.socket.cipher())
+        except IOError as e:
+            logging.warning(str(e))
+            raise messages.HTTPException(
+                "failed to build secure connection to %s" % self.host)
+
+
+class DeliveryClient(client.Client):
+
+    """An OData client that keeps statistics on its connection pool
+
+    The keyword arguments are those of the pyslet client: use
+    max_connections to size the pool and max_inactive to set how long
+    idle connections are kept alive.
+
+    Secure connections are all wrapped with a single SSLContext, so the
+    certificates in ca_certs are loaded once instead of once for every
+    new connection.
+
+    The statistics are returned by :meth:`get_pool_stats`.  If a
+    :class:`Metrics` instance is passed in the metrics keyword argument
+    then calls made with :meth:`process_request` are also recorded in
+    it, see :meth:`record_call`.  Instances are thread safe."""
+
+    SecureConnectionClass = DeliverySecureConnection
+
+    def __init__(self, **kwargs):
+        self.metrics = kwargs.pop('metrics', None)
+        super(DeliveryClient, self).__init__(**kwargs)
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.ssl_context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        if self.ca_certs is None:
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        else:
+            self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+            if os.path.isdir(self.ca_certs):
+                self.ssl_context.load_verify_locations(capath=self.ca_certs)
+            else:
+                self.ssl_context.load_verify_locations(cafile=self.ca_certs)
+        self.stats_lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.busy = 0
+        self.connections_created = 0
+        # creation times of connections in the last minute
+        self._created = collections.deque()
+
+    def queue_request(self, request, timeout=None):
+        start = time.time()
+        with self.stats_lock:
+            self.waiting += 1
+        try:
+            super(DeliveryClient, self).queue_request(request, timeout)
+        except http.RequestManagerBusy:
+            with self.stats_lock:
+                self.busy += 1
+            raise
+        finally:
+            wait = time.time() - start
+            with self.stats_lock:
+                self.waiting -= 1
+                self.requests += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+    def process_request(self, request, timeout=60):
+        start = time.time()
+        try:
+            super(DeliveryClient, self).process_request(request, timeout)
+        finally:
+            if request.res_bodystream is None:
+                size = len(request.res_body or '')
+            else:
+                size = request.response.get_content_length() or 0
+            entity_set, operation = self.describe_request(request)
+            self.record_call(entity_set, operation, size, time.time() - start)
+
+    def describe_request(self, request):
+        """Returns a tuple of entity set name and operation for *request*
+
+        The operation is one of query, get, navigate, count, stream,
+        insert, update or delete.  Requests for the service root are
+        described as ('', 'service') and requests for resources such
+        as $metadata and $batch use the resource name as the
+        operation."""
+        path = urllib.unquote(str(request.url.abs_path or ''))
+        if self.serviceRoot is not None:
+            root = str(self.serviceRoot.abs_path)
+            if path.startswith(root):
+                path = path[len(root):]
+        segments = [s for s in path.split('/') if s]
+        if not segments:
+            return '', 'service'
+        elif segments[0].startswith('$'):
+            return '', segments[0]
+        entity_set, paren, key = segments[0].partition('(')
+        # strip any container name
+        entity_set = entity_set.split('.')[-1]
+        method = request.method.upper()
+        if method == 'POST':
+            operation = 'insert'
+        elif method in ('PUT', 'MERGE', 'PATCH'):
+            operation = 'update'
+        elif method == 'DELETE':
+            operation = 'delete'
+        elif segments[-1] == '$count':
+            operation = 'count'
+        elif segments[-1] == '$value':
+            operation = 'stream'
+        elif len(segments) > 1:
+            operation = 'navigate'
+        elif paren:
+            operation = 'get'
+        else:
+            operation = 'query'
+        return entity_set, operation
+
+    #: the response statuses that mean a query is not supported
+    UNSUPPORTED = (400, 404, 405, 501)
+
+    @classmethod
+    def rejected(cls, err):
+        """Returns True if *err* shows that a query is not supported
+
+        err
+            A :class:`pyslet.odata2.client.UnexpectedHTTPResponse`
+            raised by a query.
+
+        The pyslet client starts the message with the response status,
+        only the statuses in :attr:`UNSUPPORTED` are taken to mean that
+        the service does not support the query.  Other failures, such
+        as 500 or 503, may be transient and return False."""
+        status = str(err).split(' ', 1)[0]
+        try:
+            return int(status) in cls.UNSUPPORTED
+        except ValueError:
+            return False
+
+    def record_call(self, entity_set, operation, size, elapsed):
+        """Records a call to the service in :attr:`metrics`
+
+        entity_set, operation
+            The labels of the call, see :meth:`describe_request`
+
+        size
+            The size of the response body in bytes
+
+        elapsed
+            The time taken by the call in seconds
+
+        Does nothing if there is no :attr:`metrics` instance."""
+        if self.metrics is None:
+            return
+        self.metrics.observe('dodata_upstream_seconds', elapsed,
+                             entity_set=entity_set, operation=operation)
+        self.metrics.observe('dodata_upstream_bytes', size,
+                             entity_set=entity_set, operation=operation)
+        self.metrics.add_step(
+            "%s %s %iB" % (entity_set or 'service', operation, size), elapsed)
+
+    def _new_connection(self, target, timeout=None):
+        connection = super(DeliveryClient, self)._new_connection(
+            target, timeout)
+        with self.stats_lock:
+            self.connections_created += 1
+            self._created.append(time.time())
+        return connection
+
+    def get_pool_stats(self):
+        """Returns a dictionary of connection pool statistics
+
+        The active and idle connections and the requests waiting for a
+        connection are counted at the time of the call.  wait times are
+        the times spent in :meth:`queue_request` waiting for a
+        connection, busy is the number of requests that timed out
+        waiting.  active and idle are None if they can't be counted.
+
+        The connections are counted using internals of the pyslet
+        client as found in pyslet 0.6.20160201."""
+        active = idle = None
+        lock = getattr(self, 'managerLock', None)
+        if lock is not None:
+            with lock:
+                targets = getattr(self, 'cActiveThreadTargets', None)
+                idle_list = getattr(self, 'cIdleList', None)
+                if targets is not None:
+                    active = len(targets)
+                if idle_list is not None:
+                    idle = len(idle_list)
+        with self.stats_lock:
+            now = time.time()
+            while self._created and self._created[0] < now - 60:
+                self._created.popleft()
+            return {
+                'max_connections': self.max_connections,
+                'active': active,
+                'idle': idle,
+                'waiting': self.waiting,
+                'requests': self.requests,
+                'mean_wait': (self.wait_total / self.requests if
+                              self.requests else 0.0),
+                'max_wait': self.wait_max,
+                'busy': self.busy,
+                'connections_created': self.connections_created,
+                'created_last_minute': len(self._created),
+                'uptime': now - self.started}
 
-US_ONDEMAND = "https://ondemand.questionmark.com/deliveryodata/%s"
-EU_ONDEMAND = "https://ondemand.questionmark.eu/deliveryodata/%s"
 
-LETTERS="ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+class WorkerStats(object):
+
+    """Request statistics for a group of serving processes
+
+    workers (1)
+        The number of worker slots
+
+    The statistics are kept in an anonymous shared memory map so they
+    must be created before the worker processes are forked.  Each
+    worker writes only to its own slot but any worker can read all of
+    them, a request to the health page served by one worker therefore
+    reports on the whole group.  Updates from multiple threads within
+    one worker are serialised with a lock, that lock does not extend
+    to other processes.  Instead, each slot starts with a sequence
+    number that is odd while the slot is being written and reads from
+    other processes are repeated until they see the same even number
+    before and after.  The only other writer is the master process,
+    which empties the slot of a worker after it has exited in case the
+    worker could not do so itself."""
+
+    #: the sequence number at the start of each slot
+    SEQ = struct.Struct('=Q')
+
+    #: the layout of the rest of a slot: pid, active requests, started,
+    #: last seen, requests, errors, total latency, maximum latency
+    SLOT = struct.Struct('=iiddqqdd')
+
+    #: the number of seconds spent trying to read a slot
+    READ_TIMEOUT = 0.1
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.lock = threading.RLock()
+        self.slot_size = self.SEQ.size + self.SLOT.size
+        self.map = mmap.mmap(-1, self.slot_size * workers)
+
+    def _read(self, slot):
+        """Returns a list of the values in *slot*
+
+        Returns None if the slot was being written every time it was
+        read for :attr:`READ_TIMEOUT` seconds, for example, by a
+        process that was killed part way through."""
+        offset = slot * self.slot_size
+        deadline = time.time() + self.READ_TIMEOUT
+        while True:
+            seq = self.SEQ.unpack_from(self.map, offset)[0]
+            if not seq % 2:
+                values = self.SLOT.unpack_from(self.map,
+                                               offset + self.SEQ.size)
+                if self.SEQ.unpack_from(self.map, offset)[0] == seq:
+                    return list(values)
+            if time.time() > deadline:
+                return None
+            # let the writer finish
+            time.sleep(0.001)
+
+    def _write(self, slot, values):
+        offset = slot * self.slot_size
+        # odd even if an earlier write was interrupted
+        seq = self.SEQ.unpack_from(self.map, offset)[0] | 1
+        self.SEQ.pack_into(self.map, offset, seq)
+        self.SLOT.pack_into(self.map, offset + self.SEQ.size, *values)
+        self.SEQ.pack_into(self.map, offset, seq + 1)
+
+    def start_worker(self, slot):
+        """Resets *slot* for the current process"""
+        now = time.time()
+        with self.lock:
+            self._write(slot, (os.getpid(), 0, now, now, 0, 0, 0.0, 0.0))
+
+    def stop_worker(self, slot):
+        """Marks *slot* as empty"""
+        with self.lock:
+            self._write(slot, (0, 0, 0.0, 0.0, 0, 0, 0.0, 0.0))
+
+    def tick(self, slot):
+        """Records that the worker in *slot* is still responsive"""
+        with self.lock:
+            values = self._read(slot)
+            values[3] = time.time()
+            self._write(slot, values)
+
+    def start_request(self, slot):
+        """Records the start of a request in *slot*"""
+        with self.lock:
+            values = self._read(slot)
+            values[1] += 1
+            self._write(slot, values)
+
+    def end_request(self, slot, latency, error=False):
+        """Records a request that took *latency* seconds"""
+        with self.lock:
+            values = self._read(slot)
+            values[1] -= 1
+            values[3] = time.time()
+            values[4] += 1
+            if error:
+                values[5] += 1
+            values[6] += latency
+            values[7] = max(values[7], latency)
+            self._write(slot, values)
+
+    def get_active(self, slot):
+        """Returns the number of requests being served in *slot*"""
+        with self.lock:
+            return self._read(slot)[1]
+
+    def get_worker(self, slot):
+        """Returns a dictionary of statistics for *slot*
+
+        Returns None if the slot is empty or can't be read."""
+        values = self._read(slot)
+        if values is None:
+            return None
+        pid, active, started, seen, requests, errors, total, max_latency = \
+            values
+        if not pid or not started:
+            return None
+        now = time.time()
+        return {
+            'slot': slot,
+            'pid': pid,
+            'uptime': now - started,
+            'idle': now - seen,
+            'active': active,
+            'requests': requests,
+            'errors': errors,
+            'mean_latency': total / requests if requests else 0.0,
+            'max_latency': max_latency}
+
+    def get_workers(self):
+        """Returns a list of dictionaries, one per running worker"""
+        result = []
+        for slot in range(self.workers):
+            worker = self.get_worker(slot)
+            if worker is not None:
+                result.append(worker)
+        return result
+
+
+class Metrics(object):
+
+    """Latency histograms and counters for one serving process
+
+    Values are recorded with :meth:`observe` in the histograms defined
+    by :attr:`HISTOGRAMS`, and counted with :meth:`increment` in the
+    counters defined by :attr:`COUNTERS`, one series for each
+    combination of label values.  They are exported by :meth:`export`
+    in the Prometheus text format.  Each worker process has its own
+    histograms and counters.
+
+    While a request is being served its route and the steps taken to
+    serve it are also recorded in a trace.  The trace is local to the
+    thread (or greenlet) serving the request, use :meth:`traced` to
+    record steps made by calls in other threads.  Instances are thread
+    safe."""
+
+    #: the bucket boundaries used for times, in seconds
+    SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0, 30.0)
+
+    #: the bucket boundaries used for sizes, in bytes
+    BYTES = (0x400, 0x1000, 0x4000, 0x10000, 0x40000, 0x100000, 0x400000,
+             0x1000000)
+
+    #: the histograms, tuples of name, buckets and help text
+    HISTOGRAMS = (
+        ('dodata_request_seconds', SECONDS,
+         "Time taken to serve requests by route"),
+        ('dodata_upstream_seconds', SECONDS,
+         "Time taken by calls to the Delivery OData service"),
+        ('dodata_upstream_bytes', BYTES,
+         "Size of responses from the Delivery OData service"),
+        ('dodata_aml_parse_seconds', SECONDS,
+         "Time taken to parse snapshot data"),
+        ('dodata_template_seconds', SECONDS,
+         "Time taken to render templates"))
+
+    #: the counters, tuples of name and help text
+    COUNTERS = (
+        ('dodata_reads_total',
+         "Reads from the Delivery OData service that may be coalesced"),
+        ('dodata_collapsed_reads_total',
+         "Reads that shared an identical read already in flight"))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        for name, buckets, text in self.HISTOGRAMS:
+            self.buckets[name] = buckets
+        # [bucket counts, sum, count] keyed on (name, labels)
+        self.series = {}
+        # counts keyed on (name, labels)
+        self.counts = collections.defaultdict(int)
+        self.local = threading.local()
+
+    def observe(self, name, value, **labels):
+        """Records *value* in histogram *name*
+
+        The keyword arguments are the labels of the series."""
+        buckets = self.buckets[name]
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(buckets, value)
+        with self.lock:
+            series = self.series.get(key, None)
+            if series is None:
+                series = [[0] * (len(buckets) + 1), 0.0, 0]
+                self.series[key] = series
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def increment(self, name, **labels):
+        """Adds one to counter *name*
+
+        The keyword arguments are the labels of the series."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counts[key] += 1
+
+    def start_trace(self):
+        """Starts the trace of a request in the current thread"""
+        self.local.trace = {'route': None, 'steps': []}
+
+    def end_trace(self):
+        """Ends the trace of the current thread's request
+
+        Returns a dictionary with the route of the request (None if it
+        was not dispatched) and a list of the steps recorded as
+        (description, seconds) tuples."""
+        trace = getattr(self.local, 'trace', None)
+        self.local.trace = None
+        return trace
+
+    def set_route(self, route):
+        """Sets the route of the current thread's request"""
+        trace = getattr(self.local, 'trace', None)
+        if trace is not None:
+            trace['route'] = route
+
+    def add_step(self, description, seconds):
+        """Adds a step to the trace of the current thread's request
+
+        Steps made outside the serving of a request are ignored."""
+        trace = getattr(self.local, 'trace', None)
+        if trace is not None:
+            trace['steps'].append((description, seconds))
+
+    def traced(self, func):
+        """Returns a function that calls *func* in the current trace
+
+        Used to wrap calls that are submitted to a thread pool so that
+        the steps they make are added to the trace of the request that
+        submitted them."""
+        trace = getattr(self.local, 'trace', None)
+
+        def call(*args, **kwargs):
+            self.local.trace = trace
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.trace = None
+        return call
+
+    @staticmethod
+    def format_labels(labels, **extra):
+        result = []
+        for name, value in labels + tuple(sorted(extra.items())):
+            value = unicode(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n')
+            result.append('%s="%s"' % (name, value))
+        if result:
+            return "{%s}" % ",".join(result)
+        else:
+            return ""
+
+    def export(self):
+        """Returns the histograms and counters in the Prometheus text
+        format
+
+        The result is a unicode string."""
+        with self.lock:
+            series = [(key, list(value[0]), value[1], value[2]) for
+                      key, value in self.series.items()]
+            counters = sorted(self.counts.items())
+        series.sort()
+        lines = []
+        for name, buckets, text in self.HISTOGRAMS:
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s histogram" % name)
+            for key, counts, total, count in series:
+                if key[0] != name:
+                    continue
+                labels = key[1]
+                cumulative = 0
+                for le, n in zip(buckets + ('+Inf', ), counts):
+                    cumulative += n
+                    lines.append("%s_bucket%s %i" % (
+                        name, self.format_labels(labels, le=le), cumulative))
+                lines.append("%s_sum%s %r" % (
+                    name, self.format_labels(labels), total))
+                lines.append("%s_count%s %i" % (
+                    name, self.format_labels(labels), count))
+        for name, text in self.COUNTERS:
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s counter" % name)
+            for key, count in counters:
+                if key[0] == name:
+                    lines.append("%s%s %i" % (
+                        name, self.format_labels(key[1]), count))
+        lines.append("")
+        return u"\n".join(lines)
 
 
 class DemoApp(DjangoApp):
@@ -47,7 +2473,19 @@ class DemoApp(DjangoApp):
         
         -u, --user          Set the service user name (defaults to customer_id)
         
-        --password          Set the password (if not given, will prompt)"""
+        --password          Set the password (if not given, will prompt)
+
+        -w, --workers       Serve requests from this many processes
+
+        --graceful-timeout  Seconds to wait for workers to finish
+
+        --async             Serve up to this many requests at once using
+                            gevent (requires gevent)
+
+        --max-connections   Maximum connections to the Delivery OData
+                            service in each process
+
+        --keep-alive        Seconds to keep idle connections open"""
         super(DemoApp, cls).add_options(parser)
         parser.add_option(
             "--cert", dest="cert", default=None,
@@ -60,12 +2498,73 @@ class DemoApp(DjangoApp):
                           help="user name for basic auth credentials")
         parser.add_option("--password", dest="password",
                           help="password for basic auth credentials")
+        parser.add_option("-w", "--workers", dest="workers", type="int",
+                          default=None,
+                          help="number of worker processes (0 for none)")
+        parser.add_option(
+            "--graceful-timeout", dest="graceful_timeout", type="float",
+            default=None,
+            help="seconds allowed for workers to finish when stopping")
+        parser.add_option(
+            "--async", dest="async_connections", type="int", default=None,
+            help="maximum number of requests served at once by gevent")
+        parser.add_option(
+            "--max-connections", dest="max_connections", type="int",
+            default=None,
+            help="maximum number of connections to the service")
+        parser.add_option(
+            "--keep-alive", dest="keep_alive", type="float", default=None,
+            help="seconds to keep idle connections to the service open")
 
     #: URL of the Delivery OData service 
     deliveryodata = None
     
     #: path to the certifcate file
     ca_path = None
+
+    #: the :class:`SnapshotCache` shared by all instances
+    snapshot_cache = None
+
+    #: the :class:`SnapshotIndex` shared by all instances
+    snapshot_index = None
+
+    #: the :class:`AttemptIndex` shared by all instances
+    attempt_index = None
+
+    #: the :class:`SnapshotStore` shared by all instances, None if
+    #: snapshot data is not stored on disk
+    snapshot_store = None
+
+    #: whether or not the service supports $filter on AssessmentSnapshots,
+    #: None if not yet known
+    snapshot_filter = None
+
+    #: whether or not the service supports $count on a group's
+    #: Participants, None if not yet known
+    participant_count = None
+
+    #: the :class:`GroupCountCache` shared by all instances
+    group_counts = None
+
+    #: the :class:`MetadataCache` shared by all instances, None if the
+    #: metadata is always loaded from the service
+    metadata_cache = None
+
+    #: the process ID of the master process when running as a worker
+    master_pid = None
+
+    #: a dictionary of (mtime, size, ETag) for static files, keyed on
+    #: file path
+    file_etags = {}
+
+    #: the :class:`WorkerStats` for the serving processes
+    worker_stats = None
+
+    #: the slot in :attr:`worker_stats` used by this process
+    worker_slot = 0
+
+    #: the :class:`Metrics` for this process
+    metrics = None
     
     @classmethod
     def setup(cls, options=None, args=None, **kwargs):
@@ -81,6 +2580,12 @@ class DemoApp(DjangoApp):
         source's create table script is output to standard output and
         sys.exit(0) is used to terminate the process."""
         super(DemoApp, cls).setup(options, args, **kwargs)
+        if not cls.debug:
+            # load and compile each template once per process
+            django_settings.TEMPLATE_LOADERS = (
+                ('django.template.loaders.cached.Loader', (
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader')),)
         settings = cls.settings.setdefault('DemoApp', {})
         customer_id = settings.setdefault('customer_id', None)
         url = settings.setdefault('deliveryodata', None)
@@ -114,37 +2619,562 @@ class DemoApp(DjangoApp):
             elif not url.endswith('/'):
                 url = url + '/'
         else:
-            sys.exit("One of customer id or Delivery OData URL is required")
-        if options and options.cert:
-            # grab the certificate from the live server
-            cls.ca_path = options.cert
-        settings.setdefault('user', customer_id)
-        if options and options.user is not None:
-            settings['user'] = options.user
-        settings.setdefault('password', None)
-        if options and options.password is not None:
-            settings['password'] = options.password
-        if not settings['password']:
-            settings['password'] = getpass.getpass()        
+            sys.exit("One of customer id or Delivery OData URL is required")
+        if options and options.cert:
+            # grab the certificate from the live server
+            cls.ca_path = options.cert
+        settings.setdefault('user', customer_id)
+        if options and options.user is not None:
+            settings['user'] = options.user
+        settings.setdefault('password', None)
+        if options and options.password is not None:
+            settings['password'] = options.password
+        if not settings['password']:
+            settings['password'] = getpass.getpass()        
+        settings.setdefault('async_connections', 0)
+        if options and options.async_connections is not None:
+            settings['async_connections'] = options.async_connections
+        if settings['async_connections'] > 0:
+            if gevent is None:
+                sys.exit("Asynchronous serving requires gevent")
+            # this module and pyslet have already been imported so
+            # anything they create at import time uses the unpatched
+            # threading and socket modules, our locks, thread locals
+            # and connections are created later
+            gevent.monkey.patch_all()
+        cls.metrics = Metrics()
+        settings.setdefault('slow_request_time', 0)
+        cls.snapshot_cache = SnapshotCache(
+            max_entries=settings.setdefault('snapshot_cache_entries', 64),
+            max_size=settings.setdefault('snapshot_cache_size', 0x4000000))
+        cls.snapshot_index = SnapshotIndex()
+        cls.attempt_index = AttemptIndex(
+            settings.setdefault('attempt_index_batches', 64))
+        store_path = settings.setdefault('snapshot_store', None)
+        store_size = settings.setdefault('snapshot_store_size', 0x40000000)
+        if store_path:
+            cls.snapshot_store = SnapshotStore(os.path.abspath(store_path),
+                                               store_size)
+        cache_path = settings.setdefault('metadata_cache', None)
+        cache_ttl = settings.setdefault('metadata_cache_ttl', 300)
+        if cache_path and not isinstance(cls.deliveryodata, FileURL):
+            cls.metadata_cache = MetadataCache(os.path.abspath(cache_path),
+                                               cache_ttl)
+        cls.snapshot_filter = settings.setdefault('snapshot_filter', None)
+        cls.participant_count = settings.setdefault('participant_count', None)
+        AnswerUploader.attempt_filter = settings.setdefault(
+            'attempt_filter', None)
+        cls.group_counts = GroupCountCache(
+            settings.setdefault('group_count_ttl', 300))
+        settings.setdefault('page_size', 50)
+        settings.setdefault('fragment_cache_ttl', 0)
+        settings.setdefault('compress_level', 6)
+        settings.setdefault('static_max_age', 3600)
+        settings.setdefault('fetch_threads', 8)
+        settings.setdefault('entity_cache_ttl', {
+            'Assessments': 300, 'Groups': 300, 'Participants': 300})
+        settings.setdefault('entity_cache_entries', 1024)
+        settings.setdefault('batch_manifests', None)
+        settings.setdefault('batch_manifest_ttl', 60)
+        settings.setdefault('batch_manifest_entries', 64)
+        settings.setdefault('render_processes', 0)
+        settings.setdefault('prefetch_threads', 2)
+        settings.setdefault('prefetch_queue', 100)
+        settings.setdefault('upload_threads', 4)
+        settings.setdefault('upload_retries', 3)
+        settings.setdefault('workers', 0)
+        if options and options.workers is not None:
+            settings['workers'] = options.workers
+        settings.setdefault('graceful_timeout', 30)
+        if options and options.graceful_timeout is not None:
+            settings['graceful_timeout'] = options.graceful_timeout
+        cls.worker_stats = WorkerStats(max(settings['workers'], 1))
+        settings.setdefault('max_connections', 100)
+        if options and options.max_connections is not None:
+            settings['max_connections'] = options.max_connections
+        settings.setdefault('keep_alive', 10)
+        if options and options.keep_alive is not None:
+            settings['keep_alive'] = options.keep_alive
+
+    def __init__(self, **kwargs):
+        super(DemoApp, self).__init__(**kwargs)
+        if self.ca_path is None:
+            logging.warning("No certificate path set, SSL communication may "
+                            "be vulnerable to MITM attacks")
+        settings = self.settings['DemoApp']
+        processes = settings['render_processes']
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if settings['async_connections'] > 0:
+            # waiting for the pool would block every other request
+            processes = 0
+        #: the number of processes in :attr:`render_pool`
+        self.render_processes = processes
+        #: the process pool used to render scan sheets, None if disabled
+        if processes > 0:
+            # created first, while this is the only thread
+            self.render_pool = multiprocessing.Pool(
+                processes, signal.signal, (signal.SIGINT, signal.SIG_IGN))
+        else:
+            self.render_pool = None
+        self.client = DeliveryClient(
+            ca_certs=self.ca_path,
+            max_connections=settings['max_connections'],
+            max_inactive=settings['keep_alive'],
+            metrics=self.metrics)
+        self.cookie_store = http.cookie.CookieStore()
+        self.client.set_cookie_store(self.cookie_store)
+        self.load_service()
+        credentials = auth.BasicCredentials()
+        credentials.userid = self.settings['DemoApp']['user']
+        credentials.password = self.settings['DemoApp']['password']
+        credentials.protectionSpace = \
+            self.client.serviceRoot.GetCanonicalRoot()
+        credentials.add_success_path(self.client.serviceRoot.abs_path)
+        self.client.add_credentials(credentials)
+        self.container = self.client.model.DataServices.defaultContainer
+        #: the :class:`SingleFlight` that coalesces identical reads
+        self.single_flight = SingleFlight(self.metrics)
+        #: the :class:`EntityCache` used by :meth:`get_entity`
+        self.entity_cache = EntityCache(
+            self.container, self.settings['DemoApp']['entity_cache_ttl'],
+            self.settings['DemoApp']['entity_cache_entries'])
+        manifest_path = self.settings['DemoApp']['batch_manifests']
+        if manifest_path:
+            manifest_path = os.path.abspath(manifest_path)
+        #: the :class:`BatchManifestStore` used by :meth:`get_batch`
+        self.batch_manifests = BatchManifestStore(
+            self.container, manifest_path,
+            self.settings['DemoApp']['batch_manifest_ttl'],
+            self.settings['DemoApp']['batch_manifest_entries'])
+        fetch_threads = self.settings['DemoApp']['fetch_threads']
+        #: the thread pool used for concurrent reads, None if disabled
+        if self.settings['DemoApp']['async_connections'] > 0:
+            # greenlets are cheap, one per read
+            self.fetch_pool = gevent.pool.Group()
+        elif fetch_threads > 0:
+            self.fetch_pool = ThreadPool(fetch_threads)
+        else:
+            self.fetch_pool = None
+        prefetch_threads = self.settings['DemoApp']['prefetch_threads']
+        #: the :class:`Prefetcher` that warms caches in the background,
+        #: None if disabled
+        if prefetch_threads > 0:
+            self.prefetcher = Prefetcher(
+                prefetch_threads, self.settings['DemoApp']['prefetch_queue'],
+                self.busy)
+        else:
+            self.prefetcher = None
+
+    def load_service(self):
+        """Loads the service and metadata documents into the client
+
+        If there is a :attr:`metadata_cache` the documents are loaded
+        from the local copies, downloading them first if necessary.
+        Stale copies are revalidated in a background thread after they
+        have been loaded, see :meth:`revalidate_service`."""
+        cache = self.metadata_cache
+        info = None
+        if cache is not None:
+            info = cache.get(self.deliveryodata)
+            if info is None:
+                try:
+                    cache.update(self.client, self.deliveryodata)
+                    info = cache.get(self.deliveryodata)
+                except Exception as err:
+                    logging.warning("Failed to cache service metadata: %s",
+                                    str(err))
+        if info is not None:
+            try:
+                self.client.LoadService(URI.from_path(info['service']),
+                                        URI.from_path(info['metadata']))
+            except (IOError, client.ClientException,
+                    xml.XMLError) as err:
+                # replaced or damaged, use the service itself
+                logging.warning("Failed to load cached metadata: %s",
+                                str(err))
+                info = None
+        if info is None:
+            self.client.LoadService(self.deliveryodata)
+        elif cache.stale(info):
+            t = threading.Thread(target=self.revalidate_service)
+            t.setDaemon(True)
+            t.start()
+
+    def revalidate_service(self):
+        """Revalidates the cached service and metadata documents
+
+        If the documents have changed the cache is updated.  The new
+        documents are only loaded by new instances: when running as a
+        worker the master process is asked to restart the workers,
+        otherwise a warning is logged."""
+        try:
+            changed = self.metadata_cache.update(self.client,
+                                                 self.deliveryodata)
+        except Exception as err:
+            logging.warning("Failed to revalidate service metadata: %s",
+                            str(err))
+            return
+        if not changed:
+            logging.info("Cached service metadata is up to date")
+        elif self.master_pid is not None:
+            logging.warning("Service metadata has changed, restarting "
+                            "workers")
+            os.kill(self.master_pid, signal.SIGHUP)
+        else:
+            logging.warning("Service metadata has changed, restart to "
+                            "use the new metadata")
+
+    def __call__(self, environ, start_response):
+        """Records each request in :attr:`worker_stats` and :attr:`metrics`
+
+        The latency of a request is measured until its response has
+        been iterated so streamed responses are timed in full.  Requests
+        that raise an exception or return a 5xx status are counted as
+        errors.
+
+        If the slow_request_time setting is non-zero then requests that
+        take at least that many seconds are logged with the steps taken
+        to serve them."""
+        status = []
+
+        def record_status(status_line, headers, exc_info=None):
+            status.append(status_line)
+            return start_response(status_line, headers, exc_info)
+        start = time.time()
+        self.worker_stats.start_request(self.worker_slot)
+        self.metrics.start_trace()
+        failed = True
+        try:
+            for data in self.encode_response(environ, record_status):
+                yield data
+            failed = False
+        except GeneratorExit:
+            # the client went away, not our fault
+            failed = False
+            raise
+        finally:
+            latency = time.time() - start
+            self.worker_stats.end_request(
+                self.worker_slot, latency,
+                failed or not status or status[-1].startswith('5'))
+            trace = self.metrics.end_trace()
+            self.metrics.observe('dodata_request_seconds', latency,
+                                 route=trace['route'] or '')
+            slow = self.settings['DemoApp']['slow_request_time']
+            if slow and latency >= slow:
+                logging.warning(
+                    "Slow request %s %s: %.3fs, %s %s",
+                    environ.get('REQUEST_METHOD'),
+                    environ.get('PATH_INFO'), latency,
+                    status[-1] if status else 'no response',
+                    "; ".join("%s %.3fs" % step for step in trace['steps']))
+
+    #: media types of responses that may be compressed, entries ending
+    #: in / match any subtype
+    COMPRESS_TYPES = ('text/', 'application/xml', 'application/json',
+                      'application/javascript', 'application/atom+xml',
+                      'application/atomsvc+xml', 'image/svg+xml')
+
+    #: responses with a smaller Content-Length are not compressed
+    COMPRESS_MIN_SIZE = 1024
+
+    def encode_response(self, environ, start_response):
+        """Calls the application, compressing the response if possible
+
+        Responses with a type in :attr:`COMPRESS_TYPES` get a Vary
+        header.  A 200 response of one of these types is compressed
+        with gzip or deflate, whichever the client prefers according
+        to its Accept-Encoding header, unless it is already encoded or
+        too small.  The data is compressed as it is generated so large
+        and streamed responses are compressed without buffering.
+
+        The compressed response gets its own ETag, formed by adding the
+        coding to the ETag of the original, and If-None-Match headers
+        are rewritten to match so conditional requests continue to
+        work."""
+        coding = None
+        level = self.settings['DemoApp']['compress_level']
+        if level > 0:
+            coding = self.get_content_coding(environ)
+        suffix = '-' + coding + '"' if coding else None
+        rewritten = False
+        if coding and suffix in environ.get('HTTP_IF_NONE_MATCH', ''):
+            environ['HTTP_IF_NONE_MATCH'] = \
+                environ['HTTP_IF_NONE_MATCH'].replace(suffix, '"')
+            rewritten = True
+        encoder = []
+
+        def compress_response(status_line, headers, exc_info=None):
+            # may be called again with exc_info to replace the headers
+            del encoder[:]
+            values = dict((h.lower(), v) for h, v in headers)
+            mtype = values.get('content-type', '').split(';')[0].strip()
+            if [t for t in self.COMPRESS_TYPES if t == mtype or
+                    (t.endswith('/') and mtype.startswith(t))]:
+                headers = [(h, v) for h, v in headers if h.lower() != 'vary']
+                vary = values.get('vary', None)
+                headers.append(('Vary', vary + ', Accept-Encoding' if vary
+                                else 'Accept-Encoding'))
+                length = values.get('content-length', None)
+                if (coding and status_line.startswith('200') and
+                        'content-encoding' not in values and
+                        (length is None or
+                         int(length) >= self.COMPRESS_MIN_SIZE)):
+                    headers = [(h, v) for h, v in headers
+                               if h.lower() not in ('content-length', 'etag')]
+                    headers.append(('Content-Encoding', coding))
+                    if 'etag' in values:
+                        headers.append(('ETag', self.encoded_etag(
+                            values['etag'], coding)))
+                    if coding == 'gzip':
+                        encoder.append(zlib.compressobj(
+                            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS))
+                    else:
+                        encoder.append(zlib.compressobj(level))
+            if rewritten and status_line.startswith('304'):
+                headers = [(h, self.encoded_etag(v, coding) if
+                            h.lower() == 'etag' else v) for h, v in headers]
+            return start_response(status_line, headers, exc_info)
+        for data in super(DemoApp, self).__call__(environ, compress_response):
+            if encoder and data:
+                # flush each chunk so streamed output isn't held back
+                data = encoder[0].compress(data) + \
+                    encoder[0].flush(zlib.Z_SYNC_FLUSH)
+            yield data
+        if encoder and environ.get('REQUEST_METHOD', '').upper() != 'HEAD':
+            # the headers have been sent, even an empty body must be a
+            # complete stream
+            yield encoder[0].flush()
+
+    def get_content_coding(self, environ):
+        """Returns the preferred content coding of the client
+
+        Returns "gzip", "deflate" or None if the Accept-Encoding header
+        does not accept either of them."""
+        value = environ.get('HTTP_ACCEPT_ENCODING', None)
+        if not value:
+            return None
+        best = None
+        best_q = 0
+        for item in value.split(','):
+            parts = item.split(';')
+            coding = parts[0].strip().lower()
+            q = 1.0
+            for p in parts[1:]:
+                name, sep, qvalue = p.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        q = float(qvalue)
+                    except ValueError:
+                        q = 0
+            if coding == 'x-gzip':
+                coding = 'gzip'
+            if coding in ('gzip', 'deflate') and (
+                    q > best_q or (q == best_q and coding == 'gzip')):
+                best = coding
+                best_q = q
+        return best
+
+    def encoded_etag(self, etag, coding):
+        """Returns the ETag of *etag* for a response encoded with *coding*"""
+        etag = etag.strip()
+        if etag.endswith('"'):
+            return etag[:-1] + '-' + coding + '"'
+        return etag
+
+    @classmethod
+    def run_workers(cls):
+        """Serves requests from a pool of worker processes
+
+        The listening socket is opened once and shared by the number of
+        processes given in the workers setting.  Each worker creates its
+        own instance of the class after it has been forked, and hence
+        its own client and connection pool.  Workers that exit
+        unexpectedly are replaced.
+
+        SIGHUP restarts the workers one at a time: a replacement is
+        started before each old worker is stopped and the old worker
+        finishes the request it is serving before it exits.  SIGTERM and
+        SIGINT stop all the workers, workers that are still busy after
+        graceful_timeout seconds are killed."""
+        settings = cls.settings['DemoApp']
+        nworkers = settings['workers']
+        port = cls.settings['WSGIApp']['port']
+        if cls.settings['WSGIApp']['interactive']:
+            logging.warning("Interactive mode is not available with workers")
+        server = make_server('', port, None)
+        # every idle worker waits for the socket to become readable,
+        # the first to accept the connection handles it and the others
+        # get EAGAIN and go back to waiting
+        server.socket.setblocking(0)
+        server.timeout = 1.0
+        # one spare slot for the replacement during a restart
+        cls.worker_stats = WorkerStats(nworkers + 1)
+        free_slots = range(nworkers + 1)
+        # dictionary of slot and start time keyed on pid
+        workers = {}
+        retiring = set()
+        state = {'stop': False, 'restart': []}
+
+        def stop(signum, frame):
+            state['stop'] = True
+
+        def restart(signum, frame):
+            logging.info("Restarting workers")
+            state['restart'] = [pid for pid in workers if
+                                pid not in retiring]
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, restart)
+        logging.info("Starting %s server on port %s with %i workers",
+                     cls.__name__, port, nworkers)
+        spawn_after = 0
+        deadline = None
+        try:
+            while True:
+                while workers:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                    if not pid:
+                        break
+                    slot, started = workers.pop(pid)
+                    cls.worker_stats.stop_worker(slot)
+                    free_slots.append(slot)
+                    if pid in retiring:
+                        retiring.remove(pid)
+                    elif not state['stop']:
+                        logging.error("Worker %i exited with status %i",
+                                      pid, status)
+                        if time.time() - started < 5:
+                            # failing on startup, don't spin
+                            spawn_after = time.time() + 5
+                now = time.time()
+                if state['stop']:
+                    if not workers:
+                        break
+                    if deadline is None:
+                        deadline = now + settings['graceful_timeout']
+                        for pid in workers:
+                            os.kill(pid, signal.SIGTERM)
+                    elif now > deadline:
+                        logging.warning("Killing %i busy workers",
+                                        len(workers))
+                        for pid in workers:
+                            os.kill(pid, signal.SIGKILL)
+                        deadline = now + 60
+                else:
+                    while (len(workers) - len(retiring) < nworkers and
+                            now >= spawn_after):
+                        slot = free_slots.pop(0)
+                        pid = os.fork()
+                        if not pid:
+                            code = 1
+                            try:
+                                code = cls.run_worker(server, slot)
+                            except Exception:
+                                logging.exception("Worker %i failed",
+                                                  os.getpid())
+                            finally:
+                                os._exit(code)
+                        workers[pid] = (slot, now)
+                    if state['restart'] and not retiring and \
+                            len(workers) == nworkers:
+                        pid = state['restart'].pop(0)
+                        if pid in workers:
+                            # the next loop starts a replacement
+                            retiring.add(pid)
+                            os.kill(pid, signal.SIGTERM)
+                time.sleep(0.2)
+        finally:
+            server.server_close()
+        logging.info("Stopped %s server", cls.__name__)
+
+    @classmethod
+    def run_worker(cls, server, slot):
+        """Serves requests from *server* in a forked worker process
+
+        Returns the exit status for the process when the worker has been
+        stopped with SIGTERM."""
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        cls.worker_slot = slot
+        cls.master_pid = os.getppid()
+        cls.worker_stats.start_worker(slot)
+        app = cls()
+
+        def stop(signum, frame):
+            app.stop = True
+        signal.signal(signal.SIGTERM, stop)
+        logging.info("Worker %i ready", os.getpid())
+        if cls.settings['DemoApp']['async_connections'] > 0:
+            app.serve_async(server.socket)
+        else:
+            server.set_app(app.call_wrapper)
+            while not app.stop:
+                server.handle_request()
+                cls.worker_stats.tick(slot)
+        if app.render_pool is not None:
+            # os._exit skips the clean up of the pool's processes
+            app.render_pool.terminate()
+        cls.worker_stats.stop_worker(slot)
+        return 0
+
+    def run_server(self):
+        """Runs the server in a single process
+
+        If the async_connections setting is non-zero then requests are
+        served by :meth:`serve_async` until the process receives SIGTERM
+        or SIGINT.  The process is registered in :attr:`worker_slot` so
+        that it is reported by the health page."""
+        self.worker_stats.start_worker(self.worker_slot)
+        try:
+            if self.settings['DemoApp']['async_connections'] <= 0:
+                return super(DemoApp, self).run_server()
+            port = self.settings['WSGIApp']['port']
+
+            def stop(signum, frame):
+                self.stop = True
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+            logging.info("Starting asynchronous %s server on port %s",
+                         self.__class__.__name__, port)
+            self.serve_async(('', port))
+        finally:
+            self.worker_stats.stop_worker(self.worker_slot)
+
+    def serve_async(self, listener):
+        """Serves requests from *listener* using gevent
+
+        listener
+            A listening socket or an address to listen on
+
+        Each request is handled in its own greenlet.  While a handler
+        waits for the Delivery OData service other requests are served,
+        so slow upstream responses don't each tie up a thread.  At most
+        async_connections requests are handled at once.  Runs until
+        :attr:`stop` is set then allows graceful_timeout seconds for the
+        requests in progress to finish."""
+        settings = self.settings['DemoApp']
+        pool = gevent.pool.Pool(settings['async_connections'])
+        server = gevent.pywsgi.WSGIServer(listener, self.call_wrapper,
+                                          spawn=pool)
+        server.start()
+        while not self.stop:
+            gevent.sleep(1)
+            self.worker_stats.tick(self.worker_slot)
+        server.stop(timeout=settings['graceful_timeout'])
+
+    def set_method(self, path, method):
+        """Labels the requests handled by *method* with *path*
+
+        The path is used as the route of the request in
+        :attr:`metrics`."""
+        def handler(context):
+            self.metrics.set_route(path)
+            return method(context)
+        super(DemoApp, self).set_method(path, handler)
 
-    def __init__(self, **kwargs):
-        super(DemoApp, self).__init__(**kwargs)
-        if self.ca_path is None:
-            logging.warning("No certificate path set, SSL communication may "
-                            "be vulnerable to MITM attacks")
-        self.client = client.Client(ca_certs=self.ca_path, max_inactive=10)
-        self.cookie_store = http.cookie.CookieStore()
-        self.client.set_cookie_store(self.cookie_store)
-        self.client.LoadService(self.deliveryodata)
-        credentials = auth.BasicCredentials()
-        credentials.userid = self.settings['DemoApp']['user']
-        credentials.password = self.settings['DemoApp']['password']
-        credentials.protectionSpace = \
-            self.client.serviceRoot.GetCanonicalRoot()
-        credentials.add_success_path(self.client.serviceRoot.abs_path)
-        self.client.add_credentials(credentials)
-        self.container = self.client.model.DataServices.defaultContainer
-        
     def init_dispatcher(self):
         """Adds pre-defined pages for this application
 
@@ -170,6 +3200,8 @@ class DemoApp(DjangoApp):
         self.set_method('/pasupload3', self.pas_upload3)
         self.set_method('/pasupload4', self.pas_upload4)
         self.set_method('/pasupload5', self.pas_upload5)
+        self.set_method('/pasuploadbatch', self.pas_upload_batch)
+        self.set_method('/pasprintbatch', self.pas_print_batch)
         self.set_method('/snapview', self.snapview)
         self.set_method('/snapviewxml', self.snapviewxml)
         self.set_method('/snapviewscan', self.snapviewscan)
@@ -179,8 +3211,23 @@ class DemoApp(DjangoApp):
         self.set_method('/new_attempt', self.new_attempt_action)
         self.set_method('/launch', self.launch)
         self.set_method('/plaunch', self.plaunch)
+        self.set_method('/health', self.health)
+        self.set_method('/stats', self.stats)
+        self.set_method('/metrics', self.metrics_page)
         self.set_method('/*', self.home)
 
+    def render_template(self, context, template_name, item):
+        """Renders a template, timing it in :attr:`metrics`"""
+        start = time.time()
+        try:
+            return super(DemoApp, self).render_template(
+                context, template_name, item)
+        finally:
+            elapsed = time.time() - start
+            self.metrics.observe('dodata_template_seconds', elapsed,
+                                 template=template_name)
+            self.metrics.add_step("render %s" % template_name, elapsed)
+
     def new_page_context(self, context):
         page_context = super(DemoApp, self).new_page_context(context)
         app_root = str(context.get_app_root())
@@ -195,16 +3242,368 @@ class DemoApp(DjangoApp):
             app_root + 'pas', True)
         page_context['url'] = self.deliveryodata
         page_context['url_user'] = self.settings['DemoApp']['user']
+        page_context['fragment_ttl'] = \
+            self.settings['DemoApp']['fragment_cache_ttl']
         return page_context
 
+    def file_response(self, context, target_path):
+        """Returns a file with a strong ETag and Cache-Control
+
+        Extends the base implementation.  The ETag is a digest of the
+        file's content (see :meth:`get_file_etag`) and the file may be
+        cached for static_max_age seconds.  Conditional requests that
+        match receive a 304 response."""
+        finfo = os.stat(target_path)
+        etag = self.get_file_etag(target_path, finfo)
+        context.add_header("ETag", etag)
+        context.add_header("Cache-Control", "public, max-age=%i" %
+                           self.settings['DemoApp']['static_max_age'])
+        if self.not_modified(context, etag, finfo.st_mtime):
+            context.add_header(
+                "Last-Modified",
+                str(params.FullDate.from_unix_time(finfo.st_mtime)))
+            context.set_status(304)
+            context.start_response()
+            return []
+        return super(DemoApp, self).file_response(context, target_path)
+
+    def get_file_etag(self, target_path, finfo):
+        """Returns a strong ETag for the file at *target_path*
+
+        finfo
+            The result of os.stat for the file
+
+        The ETag is the SHA-1 digest of the file's content, it is cached
+        in :attr:`file_etags` and only recalculated if the file's size
+        or modification time change."""
+        entry = self.file_etags.get(target_path, None)
+        if (entry is not None and entry[0] == finfo.st_mtime and
+                entry[1] == finfo.st_size):
+            return entry[2]
+        digest = hashlib.sha1()
+        with open(target_path, 'rb') as f:
+            while True:
+                chunk = f.read(self.MAX_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        etag = '"%s"' % digest.hexdigest()
+        self.file_etags[target_path] = (finfo.st_mtime, finfo.st_size, etag)
+        return etag
+
+    def get_version(self, entities):
+        """Returns a version string for a list of entities
+
+        The version is a digest of the property values of the entities,
+        in order, so it changes whenever the data shown from them
+        changes.  Templates use it to key cached fragments::
+
+            {% cache fragment_ttl name version %}...{% endcache %}
+
+        Returns an empty string without calculating the digest if the
+        fragment cache is disabled."""
+        if not self.settings['DemoApp']['fragment_cache_ttl']:
+            return ''
+        digest = hashlib.sha1()
+        for entity in entities:
+            for k, v in entity.data_items():
+                if isinstance(v, odata.edm.SimpleValue) and v:
+                    digest.update(unicode(v.value).encode('utf-8'))
+                digest.update('\x00')
+            digest.update('\x01')
+        return digest.hexdigest()
+
+    def new_fetch_group(self):
+        """Returns a new :class:`FetchGroup` that uses :attr:`fetch_pool`"""
+        return FetchGroup(self.fetch_pool, self.metrics)
+
+    def get_values(self, name):
+        """Returns a list of all the entities in entity set *name*"""
+        with self.container[name].OpenCollection() as collection:
+            return collection.values()
+
+    def get_entity(self, name, key):
+        """Returns the entity with *key* from entity set *name*
+
+        Identical concurrent calls are coalesced by
+        :attr:`single_flight`.  The returned entity may be shared and
+        must not be modified."""
+        return self.single_flight.do((name, key, ''), self.load_entity,
+                                     name, key)
+
+    def load_entity(self, name, key):
+        """Reads the entity with *key* from entity set *name*
+
+        Entities from the entity sets cached by :attr:`entity_cache` are
+        shared and must not be modified."""
+        if self.entity_cache.cached(name):
+            return self.entity_cache.get(name, key)
+        with self.container[name].OpenCollection() as collection:
+            return collection[key]
+
+    def get_related(self, entity, name, key=None):
+        """Returns entities related to *entity*
+
+        name
+            The name of the navigation property to follow
+
+        key (None)
+            The key of the related entity to return.  If None, a list of
+            all the related entities is returned instead."""
+        with entity[name].OpenCollection() as collection:
+            if key is None:
+                return collection.values()
+            else:
+                return collection[key]
+
+    def get_group_count(self, g):
+        """Returns the number of participants in Group entity *g*
+
+        The participants are counted by the service using $count.  If
+        the service does not support $count, as recorded in
+        :attr:`participant_count`, the participant keys are downloaded
+        and counted instead and the result is saved in
+        :attr:`group_counts`.  The keys are also counted when $count
+        fails for some other reason, but that failure is not recorded
+        (see :meth:`DeliveryClient.rejected`)."""
+        with g['Participants'].OpenCollection() as participants:
+            if self.participant_count is not False:
+                try:
+                    count = len(participants)
+                    supported = True
+                except ValueError as err:
+                    # the response was not a count
+                    logging.warning("Participants/$count failed: %s",
+                                    str(err))
+                    supported = False
+                except client.UnexpectedHTTPResponse as err:
+                    logging.warning("Participants/$count failed: %s",
+                                    str(err))
+                    if DeliveryClient.rejected(err):
+                        supported = False
+                    else:
+                        # may be transient, count the keys this time
+                        supported = None
+                if supported is not None and self.participant_count is None:
+                    logging.info("Participants: $count %s",
+                                 "supported" if supported else "unsupported")
+                    DemoApp.participant_count = supported
+                if supported:
+                    return count
+            gid = g['ID'].value
+            if 'ModifiedDateTime' in g:
+                version = g['ModifiedDateTime'].value
+            else:
+                version = None
+            count = self.group_counts.get(gid, version)
+            if count is None:
+                count = len(participants.keys())
+                self.group_counts.set(gid, count, version)
+            return count
+
+    def get_group(self, gid):
+        """Returns a tuple of (Group entity, participant count)"""
+        g = self.get_entity('Groups', gid)
+        return g, self.get_group_count(g)
+
+    def get_answer_key(self, s):
+        """Returns the answer key of a snapshot
+
+        s
+            An AssessmentSnapshot entity.
+
+        Returns an :class:`aml.AnswerKey` instance.  The snapshot data
+        is only downloaded if its key is not already in
+        :attr:`snapshot_cache`, it is parsed with an
+        :class:`aml.SnapshotReader` as it arrives without being buffered
+        first.  If there is a :attr:`snapshot_store` the data is read
+        from, or added to, the store.  The returned key is shared and
+        must not be modified.  Identical concurrent calls for a key that
+        is not cached share a single download."""
+        sid = s['ID'].value
+        modified = s['ModifiedDateTime'].value
+        key = self.snapshot_cache.get(sid, modified)
+        if key is not None:
+            return key
+        return self.single_flight.do(
+            ('AssessmentSnapshotsData', sid, str(modified)),
+            self.load_answer_key, s)
+
+    def load_answer_key(self, s):
+        """Loads the answer key of snapshot *s*, see
+        :meth:`get_answer_key`"""
+        sid = s['ID'].value
+        modified = s['ModifiedDateTime'].value
+        store = self.snapshot_store
+        stored = None if store is None else store.open(sid, modified)
+        if stored is not None:
+            # parse directly from the memory mapped file
+            info, data = stored
+            start = time.time()
+            try:
+                key = aml.AnswerKey.from_records(aml.SnapshotReader(data))
+            finally:
+                data.close()
+            elapsed = time.time() - start
+        else:
+            with self.container[
+                    'AssessmentSnapshotsData'].OpenCollection() as snapshots:
+                start = time.time()
+                snapshot_info, sgen = snapshots.read_stream_close(sid)
+                data = MeteredData(self.client, sgen,
+                                   'AssessmentSnapshotsData', 'stream',
+                                   time.time() - start)
+                sgen = iter(data)
+                if store is not None:
+                    mtype = snapshot_info.type
+                    sgen = store.new_writer(
+                        sid, modified, 'application/octet-stream'
+                        if mtype is None else str(mtype)).tee(sgen)
+                start = time.time()
+                waited = data.elapsed
+                key = aml.AnswerKey.from_records(aml.SnapshotReader(sgen))
+                # the data is parsed as it arrives, exclude the waits
+                elapsed = time.time() - start - (data.elapsed - waited)
+        self.metrics.observe('dodata_aml_parse_seconds', elapsed)
+        self.metrics.add_step("parse snapshot %i" % sid, elapsed)
+        self.snapshot_cache.set(sid, modified, key, sys.getsizeof(key))
+        return key
+
+    def get_batch(self, bid):
+        """Returns the :class:`BatchManifest` of PrintBatch *bid*
+
+        A manifest in :attr:`batch_manifests` is used without checking
+        until its ttl has passed.  After that the batch is read with its
+        Group and AssessmentSnapshot, a single call to the service, and
+        the manifest is used as long as none of them has been modified.
+        Otherwise, or if there is no manifest, a new manifest is made
+        with :meth:`new_batch_manifest`.  Identical concurrent calls
+        that need to contact the service share a single call."""
+        manifest = self.batch_manifests.get(bid)
+        if manifest is not None and not self.batch_manifests.stale(manifest):
+            return manifest
+        return self.single_flight.do(
+            ('PrintBatches', bid, '$expand=AssessmentSnapshot,Group'),
+            self.load_batch, bid, manifest)
+
+    def load_batch(self, bid, manifest):
+        """Revalidates or creates the manifest of PrintBatch *bid*
+
+        manifest
+            The existing manifest, or None.  See :meth:`get_batch`."""
+        with self.container['PrintBatches'].OpenCollection() as batches:
+            batches.set_expand({"AssessmentSnapshot": None,
+                                "Group": None})
+            b = batches[bid]
+            g = b['Group'].GetEntity()
+            s = b['AssessmentSnapshot'].GetEntity()
+        if (manifest is not None and
+                manifest.versions == BatchManifest.get_versions(b, g, s)):
+            self.batch_manifests.revalidated(manifest)
+            return manifest
+        return self.new_batch_manifest(b, g, s)
+
+    def busy(self):
+        """Returns True if this process is serving any requests"""
+        return self.worker_stats.get_active(self.worker_slot) > 0
+
+    def warm_batch(self, b, g, s, a):
+        """Creates the manifest of a new PrintBatch
+
+        The arguments are as for :meth:`new_batch_manifest`.  Run by the
+        :attr:`prefetcher`, a :meth:`get_batch` call for the same batch
+        made in the meantime shares the work."""
+        self.single_flight.do(
+            ('PrintBatches', b['ID'].value,
+             '$expand=AssessmentSnapshot,Group'),
+            self.new_batch_manifest, b, g, s, a)
+
+    def new_batch_manifest(self, b, g, s, a=None):
+        """Creates and saves the :class:`BatchManifest` of a PrintBatch
+
+        b, g, s
+            The PrintBatch and its Group and AssessmentSnapshot entities
+
+        a (None)
+            The Assessment entity, read from the service if None
+
+        The participants, the assessment and the answer key are fetched
+        concurrently."""
+        fetch = self.new_fetch_group()
+        fetch.submit(self.get_related, g, 'Participants')
+        fetch.submit(self.get_answer_key, s)
+        if a is None:
+            fetch.submit(self.get_entity, 'Assessments',
+                         s['AssessmentID'].value)
+            plist, key, a = fetch.join()
+        else:
+            plist, key = fetch.join()
+        manifest = BatchManifest.new(self.container, b, g, s, a, plist, key)
+        self.batch_manifests.set(manifest)
+        return manifest
+
+    def get_assessment_snapshots(self, aid):
+        """Returns a list of the AssessmentSnapshots of an assessment
+
+        aid
+            The ID of the assessment
+
+        We don't have a navigation from Assessment to AssessmentSnapshot
+        yet so the snapshots are found by filtering the
+        AssessmentSnapshots collection on the server.  If the service
+        does not support the filter, as recorded in
+        :attr:`snapshot_filter`, the snapshots are looked up in the
+        :attr:`snapshot_index` instead.  The index is also used when
+        the filter fails for some other reason, but that failure is
+        not recorded (see :meth:`DeliveryClient.rejected`)."""
+        with self.container[
+                'AssessmentSnapshots'].OpenCollection() as snapshots:
+            if self.snapshot_filter is not False:
+                aid_value = odata.edm.EDMValue.NewSimpleValue(
+                    odata.edm.SimpleType.Int64)
+                parser = odata.Parser("AssessmentID eq :aid")
+                filter = parser.parse_common_expression({'aid': aid_value})
+                aid_value.set_from_value(aid)
+                snapshots.set_filter(filter)
+                try:
+                    results = snapshots.values()
+                    supported = True
+                    for s in results:
+                        if s['AssessmentID'].value != aid:
+                            # the filter was ignored!
+                            supported = False
+                            break
+                except client.UnexpectedHTTPResponse as err:
+                    logging.warning("AssessmentSnapshots: $filter failed: %s",
+                                    str(err))
+                    results = None
+                    if DeliveryClient.rejected(err):
+                        supported = False
+                    else:
+                        # may be transient, use the index this time
+                        supported = None
+                if supported is not None and self.snapshot_filter is None:
+                    logging.info("AssessmentSnapshots: $filter %s",
+                                 "supported" if supported else "unsupported")
+                    DemoApp.snapshot_filter = supported
+                if supported:
+                    return results
+                snapshots.set_filter(None)
+                if results is not None:
+                    return [s for s in results
+                            if s['AssessmentID'].value == aid]
+            self.snapshot_index.refresh(snapshots)
+            results = []
+            for sid in self.snapshot_index.get_snapshot_ids(aid):
+                try:
+                    results.append(snapshots[sid])
+                except KeyError:
+                    # this snapshot has been deleted
+                    self.snapshot_index.discard(aid, sid)
+            return results
+
     def home(self, context):
         page_context = self.new_page_context(context)
-        with self.container['Assessments'].OpenCollection() as assessments:
-            page_context['alist'] = assessments.values()
-        with self.container['Attempts'].OpenCollection() as attempts:
-            page_context['attempts'] = attempts.values()
-        with self.container['Participants'].OpenCollection() as participants:
-            page_context['participants'] = participants.values()
         data = self.render_template(context, 'home.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
@@ -217,27 +3616,30 @@ class DemoApp(DjangoApp):
 
     def pas_prepare(self, context):
         page_context = self.new_page_context(context)
-        with self.container['Assessments'].OpenCollection() as assessments:
-            page_context['alist'] = assessments.values()
-        with self.container['AssessmentSnapshots'].OpenCollection() as snapshots:
-            page_context['snapshots'] = snapshots.values()
-        with self.container['Participants'].OpenCollection() as participants:
-            page_context['participants'] = participants.values()
+        fetch = self.new_fetch_group()
+        fetch.submit(self.get_values, 'Assessments')
+        fetch.submit(self.get_values, 'AssessmentSnapshots')
+        fetch.submit(self.get_values, 'Participants')
+        (page_context['alist'], page_context['snapshots'],
+         page_context['participants']) = fetch.join()
+        for name in ('alist', 'snapshots', 'participants'):
+            page_context[name + '_version'] = self.get_version(
+                page_context[name])
         data = self.render_template(context, 'prepare.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
 
     def pas_print(self, context):
         page_context = self.new_page_context(context)
-        with self.container['Groups'].OpenCollection() as groups:
-            page_context['groups'] = groups.values()
-        with self.container['PrintBatches'].OpenCollection() as batches:
-            blist = batches.values()
-            for b in blist:
-                b.CreatedDateTime_int = int(
-                    b['CreatedDateTime'].value.with_zone(0).get_unixtime()
-                    * 1000) - self.js_origin           
-            page_context['batches'] = blist
+        fetch = self.new_fetch_group()
+        fetch.submit(self.get_values, 'Groups')
+        fetch.submit(self.get_values, 'PrintBatches')
+        page_context['groups'], blist = fetch.join()
+        for b in blist:
+            b.CreatedDateTime_int = int(
+                b['CreatedDateTime'].value.with_zone(0).get_unixtime()
+                * 1000) - self.js_origin
+        page_context['batches'] = blist
         data = self.render_template(context, 'print.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
@@ -262,21 +3664,7 @@ class DemoApp(DjangoApp):
         aid = context.get_form_long('aid')
         page_context['gid'] = gid
         page_context['aid'] = aid
-        # We don't have a navigation from Assessment to AssessmentSnaphot yet
-        aid_value = odata.edm.EDMValue.NewSimpleValue(
-            odata.edm.SimpleType.Int64)
-        parser = odata.Parser("AssessmentID eq :aid")        
-        filter = parser.parse_common_expression({'aid': aid_value})
-        aid_value.set_from_value(aid)       
-        with self.container[
-                'AssessmentSnapshots'].OpenCollection() as snapshots:
-            # and we don't support any useful filter either!
-            # snapshots.set_filter(filter)
-            results = []
-            for s in snapshots.itervalues():
-                if s['AssessmentID'].value == aid:
-                    results.append(s)
-            page_context['snapshots'] = results
+        page_context['snapshots'] = self.get_assessment_snapshots(aid)
         data = self.render_template(context, 'print3.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
@@ -291,17 +3679,14 @@ class DemoApp(DjangoApp):
         page_context['gid'] = gid
         page_context['aid'] = aid
         page_context['sid'] = sid
-        with self.container['Groups'].OpenCollection() as groups:
-            g = groups[gid]
-            with g['Participants'].OpenCollection() as participants:
-                page_context['gcount'] = len(participants.keys())
+        fetch = self.new_fetch_group()
+        fetch.submit(self.get_group, gid)
+        fetch.submit(self.get_entity, 'Assessments', aid)
+        fetch.submit(self.get_entity, 'AssessmentSnapshots', sid)
+        (g, gcount), a, s = fetch.join()
         page_context['g'] = g
-        with self.container['Assessments'].OpenCollection() as assessments:
-            a = assessments[aid]
+        page_context['gcount'] = gcount
         page_context['a'] = a
-        with self.container[
-                'AssessmentSnapshots'].OpenCollection() as snapshots:
-            s = snapshots[sid]
         page_context['s'] = s
         data = self.render_template(context, 'print4.html', page_context)
         context.set_status(200)
@@ -315,63 +3700,124 @@ class DemoApp(DjangoApp):
         aid = context.get_form_long('aid')
         sid = context.get_form_long('sid')
         bname = context.get_form_string('bname')
-        with self.container['Groups'].OpenCollection() as groups:
-            g = groups[gid]
-            with g['Participants'].OpenCollection() as participants:
-                page_context['gcount'] = len(participants.keys())
-        page_context['g'] = g
-        with self.container['Assessments'].OpenCollection() as assessments:
-            a = assessments[aid]
-        page_context['a'] = a
-        with self.container[
-                'AssessmentSnapshots'].OpenCollection() as snapshots:
-            s = snapshots[sid]
-        page_context['s'] = s
+        fetch = self.new_fetch_group()
+        fetch.submit(self.get_group, gid)
+        fetch.submit(self.get_entity, 'Assessments', aid)
+        fetch.submit(self.get_entity, 'AssessmentSnapshots', sid)
+        (g, gcount), a, s = fetch.join()
         with self.container['PrintBatches'].OpenCollection() as batches:
             b = batches.new_entity()
             b['ID'].set_from_value(0)
             b['Name'].set_from_value(bname)
             b['SnapshotID'].set_from_value(sid)
             b['GroupID'].set_from_value(gid)
-            b['CreatedDateTime'].set_from_value(iso.TimePoint.from_now())            
-            b['ModifiedDateTime'].set_from_value(b['CreatedDateTime'].value)            
+            b['CreatedDateTime'].set_from_value(iso.TimePoint.from_now())
+            b['ModifiedDateTime'].set_from_value(b['CreatedDateTime'].value)
             batches.insert_entity(b)
-            page_context['b'] = b
-            b.CreatedDateTime_int = int(
-                b['CreatedDateTime'].value.with_zone(0).get_unixtime()
-                * 1000) - self.js_origin
-            page_context['created'] = True
+        # everything the later batch pages need is saved now, in the
+        # background if possible
+        if self.prefetcher is None or not self.prefetcher.submit(
+                ('PrintBatches', b['ID'].value), self.warm_batch, b, g, s, a):
+            self.new_batch_manifest(b, g, s, a)
+        # b now belongs to the manifest, it must not be modified
+        page_context['created_ms'] = self.get_created_ms(b)
+        page_context['b'] = b
+        page_context['g'] = g
+        page_context['gcount'] = gcount
+        page_context['a'] = a
+        page_context['s'] = s
+        page_context['created'] = True
         data = self.render_template(context, 'print5.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
 
+    def get_created_ms(self, b):
+        """Returns the creation time of PrintBatch *b* for scripts
+
+        The result is the CreatedDateTime in milliseconds since the
+        JavaScript epoch."""
+        return int(b['CreatedDateTime'].value.with_zone(0).get_unixtime()
+                   * 1000) - self.js_origin
+
+    def batch_context(self, page_context, manifest):
+        """Adds the entities in *manifest* to *page_context*
+
+        Sets b, g, s and a, the PrintBatch, Group, AssessmentSnapshot
+        and Assessment entities, and created_ms, the result of
+        :meth:`get_created_ms` for the batch.  The entities are shared
+        and must not be modified."""
+        b = manifest.batch
+        page_context['created_ms'] = self.get_created_ms(b)
+        page_context['b'] = b
+        page_context['g'] = manifest.group
+        page_context['s'] = manifest.snapshot
+        page_context['a'] = manifest.assessment
+
     def pas_print6(self, context):
         page_context = self.new_page_context(context)
         qparams = context.get_query()
         bid = long(qparams['bid'])
-        with self.container['PrintBatches'].OpenCollection() as batches:
-            batches.set_expand({"AssessmentSnapshot": None,
-                                "Group": {"Participants": None}})
-            b = batches[bid]
-            b.CreatedDateTime_int = int(
-                b['CreatedDateTime'].value.with_zone(0).get_unixtime()
-                * 1000) - self.js_origin            
-            page_context['b'] = b
-            g = b['Group'].GetEntity()
-            page_context['g'] = g
-            with g['Participants'].OpenCollection() as participants:
-                page_context['gcount'] = len(participants.keys())
-            s = b['AssessmentSnapshot'].GetEntity()
-            page_context['s'] = s
-        # Now just the Assessment object to retrieve
-        with self.container['Assessments'].OpenCollection() as assessments:
-            a = assessments[s['AssessmentID'].value]
-            page_context['a'] = a
+        manifest = self.get_batch(bid)
+        self.batch_context(page_context, manifest)
+        page_context['gcount'] = len(manifest.participants)
         page_context['created'] = False
         data = self.render_template(context, 'print5.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
 
+    #: the number of scan sheets rendered by each task in the
+    #: :attr:`render_pool`
+    SHEETS_PER_TASK = 8
+
+    def pas_print_batch(self, context):
+        """Returns the scan sheets of every participant in a batch
+
+        The sheets are rendered by the :attr:`render_pool`, or by this
+        process if there is no pool, and streamed as a single document, in participant order, as they are
+        rendered.  Only a few chunks of sheets are held in memory at any
+        one time."""
+        if context.environ['REQUEST_METHOD'].upper() != 'GET':
+            raise wsgi.MethodNotAllowed
+        qparams = context.get_query()
+        bid = long(qparams['bid'])
+        manifest = self.get_batch(bid)
+        page_context = self.new_page_context(context)
+        self.batch_context(page_context, manifest)
+        page_context['gcount'] = len(manifest.participants)
+        data = self.render_template(context, 'printbatch.html', page_context)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        head, tail = data.split(self.SHEETS_MARKER, 1)
+        b = manifest.batch
+        renderer = SheetRenderer(manifest.key, b['Name'].value)
+        participants = [(p['ID'].value, p['Name'].value) for p in
+                        manifest.participants]
+        # keep every process busy while the client reads, ignored
+        # when there is no pool
+        window = 2 * max(self.render_processes, 1)
+        context.add_header("Content-Type", "text/html; charset=utf-8")
+        context.set_status(200)
+        context.start_response()
+        return self.stream_sheets(
+            head, renderer.render_all(participants, self.render_pool,
+                                      self.SHEETS_PER_TASK, window), tail)
+
+    #: the comment in printbatch.html replaced by the sheets
+    SHEETS_MARKER = '<!-- sheets -->'
+
+    def stream_sheets(self, head, sheets, tail):
+        """Generates *head*, the chunks in *sheets* and then *tail*"""
+        yield head
+        start = time.time()
+        try:
+            for chunk in sheets:
+                yield chunk
+        finally:
+            sheets.close()
+        self.metrics.observe('dodata_template_seconds', time.time() - start,
+                             template=SheetRenderer.template_name)
+        yield tail
+
     def pas_upload(self, context):
         page_context = self.new_page_context(context)
         with self.container['Groups'].OpenCollection() as groups:
@@ -402,24 +3848,9 @@ class DemoApp(DjangoApp):
         page_context = self.new_page_context(context)
         qparams = context.get_query()
         bid = long(qparams['bid'])
-        with self.container['PrintBatches'].OpenCollection() as batches:
-            batches.set_expand({"AssessmentSnapshot": None,
-                                "Group": {"Participants": None}})
-            b = batches[bid]
-            b.CreatedDateTime_int = int(
-                b['CreatedDateTime'].value.with_zone(0).get_unixtime()
-                * 1000) - self.js_origin            
-            page_context['b'] = b
-            g = b['Group'].GetEntity()
-            page_context['g'] = g
-            with g['Participants'].OpenCollection() as participants:
-                page_context['plist'] = participants.values()
-            s = b['AssessmentSnapshot'].GetEntity()
-            page_context['s'] = s
-        # Now just the Assessment object to retrieve
-        with self.container['Assessments'].OpenCollection() as assessments:
-            a = assessments[s['AssessmentID'].value]
-            page_context['a'] = a
+        manifest = self.get_batch(bid)
+        self.batch_context(page_context, manifest)
+        page_context['plist'] = manifest.participants
         data = self.render_template(context, 'upload3.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
@@ -430,45 +3861,10 @@ class DemoApp(DjangoApp):
         page_context = self.new_page_context(context)
         bid = context.get_form_long('bid')
         pid = context.get_form_long('pid')
-        with self.container['PrintBatches'].OpenCollection() as batches:
-            batches.set_expand({"AssessmentSnapshot": None,
-                                "Group": None})
-            b = batches[bid]
-            b.CreatedDateTime_int = int(
-                b['CreatedDateTime'].value.with_zone(0).get_unixtime()
-                * 1000) - self.js_origin            
-            page_context['b'] = b
-            g = b['Group'].GetEntity()
-            page_context['g'] = g
-            with g['Participants'].OpenCollection() as participants:
-                page_context['p'] = participants[pid]
-            s = b['AssessmentSnapshot'].GetEntity()
-            sid = s['ID'].value
-            page_context['s'] = s
-        with self.container['Assessments'].OpenCollection() as assessments:
-            a = assessments[s['AssessmentID'].value]
-            page_context['a'] = a
-        with self.container[
-                'AssessmentSnapshotsData'].OpenCollection() as snapshots:
-            out = StringIO.StringIO()
-            snapshot_info = snapshots.read_stream(sid, out=out)
-            out.seek(0)
-            doc = aml.Document()
-            doc.Read(src=out)
-            qlist = []
-            for b in doc.root.BlockSnapshot:
-                if b.QuestionList:
-                    for q in b.QuestionList.Question:
-                        qlist.append(q)
-                        q.aml_qnumber = len(qlist)
-                        q.aml_choices = []
-                        if q.Answer:
-                            i = 0
-                            for c in q.Answer.AnswerThing:
-                                if isinstance(c, aml.Choice):
-                                    q.aml_choices.append(LETTERS[i])
-                                    i += 1
-        page_context['qlist'] = qlist
+        manifest = self.get_batch(bid)
+        self.batch_context(page_context, manifest)
+        page_context['p'] = manifest.get_participant(pid)
+        page_context['qlist'] = manifest.key
         data = self.render_template(context, 'upload4.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
@@ -479,93 +3875,101 @@ class DemoApp(DjangoApp):
         page_context = self.new_page_context(context)
         bid = context.get_form_long('bid')
         pid = context.get_form_long('pid')
-        with self.container['PrintBatches'].OpenCollection() as batches:
-            batches.set_expand({"AssessmentSnapshot": None,
-                                "Group": None})
-            b = batches[bid]
-            b.CreatedDateTime_int = int(
-                b['CreatedDateTime'].value.with_zone(0).get_unixtime()
-                * 1000) - self.js_origin            
-            page_context['b'] = b
-            g = b['Group'].GetEntity()
-            page_context['g'] = g
-            with g['Participants'].OpenCollection() as participants:
-                page_context['p'] = participants[pid]
-            s = b['AssessmentSnapshot'].GetEntity()
-            sid = s['ID'].value
-            page_context['s'] = s
-        with self.container['Assessments'].OpenCollection() as assessments:
-            aid = s['AssessmentID'].value
-            a = assessments[aid]
-            page_context['a'] = a
-        with self.container[
-                'AssessmentSnapshotsData'].OpenCollection() as snapshots:
-            out = StringIO.StringIO()
-            snapshot_info = snapshots.read_stream(sid, out=out)
-            out.seek(0)
-            doc = aml.Document()
-            doc.Read(src=out)
-            answer_upload = {}
-            qlist = []
-            answer_upload["QuestionAndChoices"] = qlist
-            for b in doc.root.BlockSnapshot:
-                if b.QuestionList:
-                    for q in b.QuestionList.Question:
-                        qnum = len(qlist) + 1
-                        clist = []
-                        qentry = {"QuestionOrderNumber": qnum,
-                                  "UploadedChoices": clist}
-                        qlist.append(qentry)
-                        response = context.get_form_string("q%i" % qnum)
-                        if q.Answer:
-                            i = 0
-                            for c in q.Answer.AnswerThing:
-                                if isinstance(c, aml.Choice):
-                                    centry = {
-                                        "ChoiceOrderNumber": unicode(i+1),
-                                        "Selected": LETTERS[i] in response}
-                                    clist.append(centry)
-                                    i += 1
-        with self.container['Attempts'].OpenCollection() as attempts:
-            xid = "PAS:%i:%i" % (bid, pid)
-            xid_value = odata.edm.EDMValue.NewSimpleValue(
-                odata.edm.SimpleType.String)
-            parser = odata.Parser("ExternalAttemptID eq :xid")        
-            filter = parser.parse_common_expression({'xid': xid_value})
-            xid_value.set_from_value(xid)       
-            attempts.set_filter(filter)
-            attempt = attempts.values()
-            if attempt:
-                attempt = attempt[0]
-            else:
-                attempt = attempts.new_entity()
-                attempt['ID'].set_from_value(0)
-                attempt['ExternalAttemptID'].set_from_value(xid)
-                attempt['ParticipantID'].set_from_value(pid)
-                attempt['AssessmentID'].set_from_value(aid)
-                attempt['AssessmentSnapshotID'].set_from_value(sid)
-                attempt['LockRequired'].set_from_value(True)
-                attempt['LockStatus'].set_from_value(True)            
-                attempt['LastModifiedDateTime'].set_from_value(iso.TimePoint.from_now())
-                attempts.insert_entity(attempt)
-            answer_upload['AttemptID'] = unicode(attempt['ID'].value)
-        with self.container['AnswerUploads'].OpenCollection() as uploads:
-            sinfo = odata.StreamInfo(
-                type=params.MediaType.from_str('application/json'))
-            sdata = StringIO.StringIO(
-                json.dumps(answer_upload).encode("utf-8"))
-            upload = uploads.new_stream(sdata, sinfo=sinfo)
-            page_context['upload'] = upload
+        manifest = self.get_batch(bid)
+        self.batch_context(page_context, manifest)
+        page_context['p'] = manifest.get_participant(pid)
+        key = manifest.key
+        responses = [context.get_form_string("q%i" % q.number) for q in key]
+        uploader = AnswerUploader(
+            self.container, bid, manifest.assessment['ID'].value,
+            manifest.snapshot['ID'].value, key, self.attempt_index)
+        attempt_id, answer_upload = uploader.upload(pid, responses)
         page_context['answers'] = json.dumps(answer_upload)
         data = self.render_template(context, 'upload5.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
 
+    def pas_upload_batch(self, context):
+        """Uploads the answers for a whole print batch
+
+        The form contains the batch ID (bid) and a file of responses
+        (responses) in the format read by
+        :meth:`AnswerUploader.read_responses`.  The response is a plain
+        text progress report, a line is sent as each upload finishes."""
+        if context.environ['REQUEST_METHOD'].upper() != 'POST':
+            raise wsgi.MethodNotAllowed
+        bid = context.get_form_long('bid')
+        form = context.get_form()
+        if bid is None or 'responses' not in form:
+            raise wsgi.BadRequest
+        field = form['responses']
+        if field.file is None:
+            src = StringIO.StringIO(field.value)
+        else:
+            src = field.file
+        manifest = self.get_batch(bid)
+        s = manifest.snapshot
+        uploader = AnswerUploader(self.container, bid,
+                                  s['AssessmentID'].value, s['ID'].value,
+                                  manifest.key, self.attempt_index)
+        members = set(manifest.participant_ids)
+        responses = uploader.read_responses(src)
+        context.add_header("Content-Type", "text/plain; charset=utf-8")
+        context.set_status(200)
+        context.start_response()
+        return self.upload_progress(uploader, responses, members)
+
+    def upload_progress(self, uploader, responses, members):
+        """Generates a progress report for a batch upload
+
+        uploader
+            The :class:`AnswerUploader` for the batch
+
+        responses
+            The list of responses to upload
+
+        members
+            The set of participant IDs in the batch's group, responses
+            from other participants are not uploaded."""
+        settings = self.settings['DemoApp']
+        upload = []
+        for pid, r in responses:
+            if pid in members:
+                upload.append((pid, r))
+            else:
+                yield "Participant %i: not in this group, skipped\r\n" % pid
+        sheets = uploader.decode(upload)
+        nblank = 0
+        for i, number, problem in sheets.diagnostics():
+            if problem == 'blank':
+                nblank += 1
+            elif problem == 'multiple':
+                yield "Participant %i: question %i: more than one choice " \
+                    "selected\r\n" % (upload[i][0], number)
+            else:
+                yield "Participant %i: question %i: unknown choice " \
+                    "selected\r\n" % (upload[i][0], number)
+        total = len(upload)
+        yield "Uploading answers for %i participants (%i blank " \
+            "responses)\r\n" % (total, nblank)
+        n = nerrors = 0
+        for pid, error in uploader.upload_all(
+                upload, settings['upload_threads'],
+                settings['upload_retries'], sheets):
+            n += 1
+            if error is None:
+                yield "%i/%i Participant %i: uploaded\r\n" % (n, total, pid)
+            else:
+                nerrors += 1
+                yield "%i/%i Participant %i: failed: %s\r\n" % (
+                    n, total, pid, error)
+        yield "Finished: %i uploaded, %i failed, %i skipped\r\n" % (
+            total - nerrors, nerrors, len(responses) - total)
+
     def snapview(self, context):
         qparams = context.get_query()
         sid = long(qparams['sid'])
-        with self.container['AssessmentSnapshots'].OpenCollection() as snapshots:
-            snapshot = snapshots[sid]
+        snapshot = self.get_entity('AssessmentSnapshots', sid)
         link = snapshot['PrintableDocumentSourceUrl'].value.split()
         rlink = string.join(link, '%20')
         if len(link) > 1:
@@ -576,25 +3980,207 @@ class DemoApp(DjangoApp):
             URI.from_octets(rlink),
             303)
 
+    #: request headers forwarded to the service by :meth:`snapviewxml`
+    PROXY_REQUEST_HEADERS = (
+        ('HTTP_RANGE', 'Range'),
+        ('HTTP_IF_RANGE', 'If-Range'),
+        ('HTTP_IF_NONE_MATCH', 'If-None-Match'),
+        ('HTTP_IF_MODIFIED_SINCE', 'If-Modified-Since'))
+
+    #: response headers relayed from the service by :meth:`snapviewxml`
+    PROXY_RESPONSE_HEADERS = ('Content-Type', 'Content-Length',
+                              'Content-Range', 'Accept-Ranges', 'ETag',
+                              'Last-Modified')
+
     def snapviewxml(self, context):
+        """Returns the XML of a snapshot
+
+        If :attr:`snapshot_store` is None the request is passed through
+        to the service, forwarding any range and conditional headers
+        and relaying the response, including 206 and 304 responses, as
+        it is received.  Otherwise the data is returned from the store,
+        being added to it first if necessary."""
         if context.environ['REQUEST_METHOD'].upper() != 'GET':
             raise wsgi.MethodNotAllowed
         qparams = context.get_query()
         sid = long(qparams['sid'])
+        if self.snapshot_store is None:
+            return self.proxy_snapshot(context, sid)
         try:
-            snapshots = self.container[
-                'AssessmentSnapshotsData'].OpenCollection()
-            snapshot_info, sgen = snapshots.read_stream_close(sid)
-            context.add_header("Content-Type", str(snapshot_info.type))
-            if snapshot_info.size is not None:
-                context.add_header("Content-Length", str(snapshot_info.size))
-            context.set_status(200)
+            s = self.get_entity('AssessmentSnapshots', sid)
+        except KeyError:
+            return self.error_page(context, 404)
+        modified = s['ModifiedDateTime'].value
+        stored = self.snapshot_store.open(sid, modified)
+        if stored is not None:
+            return self.stored_snapshot_response(context, stored[0],
+                                                 stored[1], modified)
+        if 'HTTP_RANGE' in context.environ:
+            # we can't store a partial response
+            return self.proxy_snapshot(context, sid)
+        return self.proxy_snapshot(context, sid, modified)
+
+    def proxy_snapshot(self, context, sid, modified=None):
+        """Relays snapshot data from the service
+
+        modified (None)
+            If given, the conditional and range headers are not
+            forwarded and the data is added to :attr:`snapshot_store` as
+            it is relayed, stored against this modification time."""
+        with self.container[
+                'AssessmentSnapshotsData'].OpenCollection() as snapshots:
+            url = str(snapshots.baseURI) + odata.ODataURI.FormatKeyDict(
+                snapshots.entity_set.GetKeyDict(sid)) + "/$value"
+        stream = ProxyStream(self.client)
+        request = http.ClientRequest(url, 'GET', res_body=stream)
+        request.set_header('Accept', '*/*')
+        if modified is None:
+            for key, header in self.PROXY_REQUEST_HEADERS:
+                value = context.environ.get(key, None)
+                if value is not None:
+                    request.set_header(header, value)
+        start = time.time()
+        stream.start_request(request)
+        data = iter(MeteredData(self.client, stream.data_gen(),
+                                'AssessmentSnapshotsData', 'stream',
+                                time.time() - start))
+        status = stream.status
+        if status == 404:
+            return self.error_page(context, 404)
+        elif status not in (200, 206, 304, 412, 416):
+            raise client.UnexpectedHTTPResponse(
+                "%i %s" % (status, request.response.reason))
+        for header in self.PROXY_RESPONSE_HEADERS:
+            value = request.response.get_header(header)
+            if value is not None:
+                context.add_header(header, value)
+        context.set_status(status)
+        context.start_response()
+        if status == 200 and modified is not None:
+            mtype = request.response.get_content_type()
+            writer = self.snapshot_store.new_writer(
+                sid, modified,
+                'application/octet-stream' if mtype is None else str(mtype))
+            return writer.tee(data)
+        return data
+
+    def stored_snapshot_response(self, context, info, data, modified):
+        """Returns snapshot data from :attr:`snapshot_store`
+
+        info, data
+            The information about the data and the memory mapped data
+            itself as returned by :meth:`SnapshotStore.open`, data is
+            closed when the response is complete.
+
+        modified
+            The ModifiedDateTime of the snapshot
+
+        Handles If-None-Match, If-Modified-Since and single byte-range
+        requests itself."""
+        etag = '"%s"' % str(info['digest'])
+        mtime = int(modified.with_zone(0).get_unixtime())
+        size = info['size']
+        context.add_header("ETag", etag)
+        context.add_header("Last-Modified",
+                           str(params.FullDate.from_unix_time(mtime)))
+        context.add_header("Accept-Ranges", "bytes")
+        if self.not_modified(context, etag, mtime):
+            data.close()
+            context.set_status(304)
             context.start_response()
-            snapshots = None
-            return sgen
+            return []
+        first, last = 0, size - 1
+        byte_range = self.get_byte_range(context, etag, size)
+        if byte_range is None:
+            context.set_status(200)
+        elif byte_range is False:
+            data.close()
+            context.add_header(
+                "Content-Range", str(http.messages.ContentRange(None, None,
+                                                                size)))
+            return self.error_page(context, 416)
+        else:
+            first, last = byte_range
+            context.add_header(
+                "Content-Range", str(http.messages.ContentRange(first, last,
+                                                                size)))
+            context.set_status(206)
+        context.add_header("Content-Type", str(info['type']))
+        context.add_header("Content-Length", str(last + 1 - first))
+        context.start_response()
+        return self.stored_data(data, first, last)
+
+    def stored_data(self, data, first, last):
+        """Generates bytes *first* to *last* of memory mapped *data*
+
+        data is closed when the generator finishes."""
+        try:
+            pos = first
+            while pos <= last:
+                end = min(pos + self.MAX_CHUNK, last + 1)
+                yield data[pos:end]
+                pos = end
         finally:
-            if snapshots is not None:
-                snapshots.close()
+            data.close()
+
+    def not_modified(self, context, etag, mtime):
+        """Returns True if the conditional headers match
+
+        etag
+            The current ETag of the resource, as a string
+
+        mtime
+            The last modification time, a unix time"""
+        if_none_match = context.environ.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+        if_modified_since = context.environ.get('HTTP_IF_MODIFIED_SINCE',
+                                                None)
+        if if_modified_since is not None:
+            try:
+                since = params.FullDate.from_http_str(if_modified_since)
+            except ValueError:
+                return False
+            return mtime <= since.get_unixtime()
+        return False
+
+    def get_byte_range(self, context, etag, size):
+        """Returns the byte range requested by the client
+
+        etag
+            The current ETag of the resource, as a string
+
+        size
+            The size of the resource in bytes
+
+        Returns a tuple of (first byte, last byte), None if the whole
+        resource should be returned or False if the range can't be
+        satisfied.  Only a single range is supported, requests for
+        multiple ranges receive the whole resource."""
+        value = context.environ.get('HTTP_RANGE', None)
+        if value is None:
+            return None
+        if_range = context.environ.get('HTTP_IF_RANGE', None)
+        if if_range is not None and if_range.strip() != etag:
+            return None
+        value = value.strip()
+        if not value.startswith('bytes=') or ',' in value:
+            return None
+        first, sep, last = value[6:].strip().partition('-')
+        try:
+            if not first:
+                # suffix range
+                first = max(size - int(last), 0)
+                last = size - 1
+            else:
+                first = int(first)
+                last = min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if first > last or first >= size:
+            return False
+        return first, last
 
     def snapviewscan(self, context):
         if context.environ['REQUEST_METHOD'].upper() != 'GET':
@@ -602,27 +4188,8 @@ class DemoApp(DjangoApp):
         qparams = context.get_query()
         sid = long(qparams['sid'])
         page_context = self.new_page_context(context)
-        with self.container[
-                'AssessmentSnapshotsData'].OpenCollection() as snapshots:
-            out = StringIO.StringIO()
-            snapshot_info = snapshots.read_stream(sid, out=out)
-            out.seek(0)
-            doc = aml.Document()
-            doc.Read(src=out)
-            qlist = []
-            for b in doc.root.BlockSnapshot:
-                if b.QuestionList:
-                    for q in b.QuestionList.Question:
-                        qlist.append(q)
-                        q.aml_qnumber = len(qlist)
-                        q.aml_choices = []
-                        if q.Answer:
-                            i = 0
-                            for c in q.Answer.AnswerThing:
-                                if isinstance(c, aml.Choice):
-                                    q.aml_choices.append(LETTERS[i])
-                                    i += 1
-        page_context['qlist'] = qlist
+        s = self.get_entity('AssessmentSnapshots', sid)
+        page_context['qlist'] = self.get_answer_key(s)
         data = self.render_template(context, 'scansheet.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)            
@@ -630,8 +4197,7 @@ class DemoApp(DjangoApp):
     def snapshot(self, context):
         qparams = context.get_query()
         aid = long(qparams['aid'])
-        with self.container['Assessments'].OpenCollection() as assessments:
-            assessment = assessments[aid]
+        assessment = self.get_entity('Assessments', aid)
         with self.container['AssessmentSnapshots'].OpenCollection() as snapshots:
             s = snapshots.new_entity()
             s['ID'].set_from_value(0)
@@ -646,6 +4212,11 @@ class DemoApp(DjangoApp):
             s['CreatedDateTime'].set_from_value(iso.TimePoint.from_now())
             s['ModifiedDateTime'].set_from_value(iso.TimePoint.from_now())
             snapshots.insert_entity(s)
+            self.snapshot_index.add(aid, s['ID'].value)
+        if self.prefetcher is not None:
+            # the answer key is needed to print and scan
+            self.prefetcher.submit(('AssessmentSnapshotsData', s['ID'].value),
+                                   self.get_answer_key, s)
         return self.redirect_page(
             context, URI.from_octets('pas').resolve(
                 context.get_app_root()), 303)
@@ -698,21 +4269,80 @@ class DemoApp(DjangoApp):
 
     def ops(self, context):
         page_context = self.new_page_context(context)
-        with self.container['Assessments'].OpenCollection() as assessments:
-            page_context['alist'] = assessments.values()
-        with self.container['Attempts'].OpenCollection() as attempts:
-            page_context['attempts'] = attempts.values()
-        with self.container['Participants'].OpenCollection() as participants:
-            page_context['participants'] = participants.values()
+        query = context.get_query()
+        page_size = self.settings['DemoApp']['page_size']
+        page_context['attempts'] = EntityPage(
+            self.container['Attempts'], 'attempts', query, page_size,
+            {'ParticipantID': None, 'AssessmentID': None,
+             'ExternalAttemptID': None})
+        page_context['alist'] = EntityPage(
+            self.container['Assessments'], 'assessments', query, page_size,
+            {'Name': None, 'Language': None})
+        page_context['participants'] = EntityPage(
+            self.container['Participants'], 'participants', query,
+            page_size, {'Name': None})
+        fetch = self.new_fetch_group()
+        for name in ('attempts', 'alist', 'participants'):
+            fetch.submit(page_context[name].load)
+        fetch.join()
+        for name in ('attempts', 'alist', 'participants'):
+            page_context[name + '_version'] = self.get_version(
+                page_context[name])
         data = self.render_template(context, 'ops.html', page_context)
         context.set_status(200)
         return self.html_response(context, data)
 
+    def health(self, context):
+        """Reports the health of the serving processes
+
+        The response is a JSON object giving the process ID of the
+        worker that served the request and the statistics for all
+        running workers, see :meth:`WorkerStats.get_worker`."""
+        data = json.dumps({'pid': os.getpid(),
+                           'workers': self.worker_stats.get_workers()})
+        context.add_header("Cache-Control", "no-cache")
+        context.set_status(200)
+        return self.json_response(context, data)
+
+    def stats(self, context):
+        """Reports the statistics of this process's connection pool
+
+        The response is a JSON object giving the process ID, the
+        result of :meth:`DeliveryClient.get_pool_stats`, the reads
+        coalesced by :attr:`single_flight`, see
+        :meth:`SingleFlight.get_stats`, and the background tasks of the
+        :attr:`prefetcher` (null if disabled), see
+        :meth:`Prefetcher.get_stats`.  Each worker has its own pool so
+        the statistics are for the worker that served the request
+        only."""
+        data = json.dumps({'pid': os.getpid(),
+                           'pool': self.client.get_pool_stats(),
+                           'coalesced': self.single_flight.get_stats(),
+                           'prefetch': None if self.prefetcher is None else
+                           self.prefetcher.get_stats()})
+        context.add_header("Cache-Control", "no-cache")
+        context.set_status(200)
+        return self.json_response(context, data)
+
+    def metrics_page(self, context):
+        """Reports the latency histograms of this process
+
+        The response is the result of :meth:`Metrics.export` in the
+        Prometheus text format.  As with :meth:`stats` the histograms
+        are those of the worker that served the request."""
+        data = self.metrics.export().encode('utf-8')
+        context.add_header("Content-Type",
+                           "text/plain; version=0.0.4; charset=utf-8")
+        context.add_header("Content-Length", str(len(data)))
+        context.add_header("Cache-Control", "no-cache")
+        context.set_status(200)
+        context.start_response()
+        return [data]
+
     def launch(self, context):
         qparams = context.get_query()
         aid = long(qparams['aid'])
-        with self.container['Attempts'].OpenCollection() as attempts:
-            attempt = attempts[aid]
+        attempt = self.get_entity('Attempts', aid)
         link = attempt['ParticipantFacingQMLobbyUrl'].value.split()
         rlink = string.join(link, '%20')
         if len(link) > 1:
@@ -734,8 +4364,7 @@ class DemoApp(DjangoApp):
     def plaunch(self, context):
         qparams = context.get_query()
         aid = long(qparams['aid'])
-        with self.container['Attempts'].OpenCollection() as attempts:
-            attempt = attempts[aid]
+        attempt = self.get_entity('Attempts', aid)
         link = attempt['ProctorFacingQMControlsWidgetUrl'].value.split()
         rlink = string.join(link, '%20')
         if len(link) > 1:
@@ -776,5 +4405,8 @@ if __name__ == '__main__':
     DemoApp.settings_file = os.path.join(os.path.split(__file__)[0],
                                              'settings.json')
     DemoApp.setup(options, args)
-    app = DemoApp()
-    app.run_server()
+    if DemoApp.settings['DemoApp']['workers'] > 0:
+        DemoApp.run_workers()
+    else:
+        app = DemoApp()
+        app.run_server()